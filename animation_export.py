@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  animation_export.py
+#
+#  Copyright 2018 Valentino Esposito <valentinoe85@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+#This module holds the export functions shared by the animation scripts (make_animation_*.py), it is not a plug-in.
+#It must be placed in ~/.gimp-n.m/plug-ins together with the animation scripts, without the executable permission
+#where n.m is the gimp version (e.g. 2.8)
+
+import re
+import struct
+import zlib
+from gimpfu import *
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+PALETTESAMPLES = 8 #number of frames used to compute the global palette
+FRAMETAGS = re.compile(r"\s*\((\d+\s*ms|combine|replace)\)")
+DELAYTAG = re.compile(r"\((\d+)\s*ms\)")
+PNGCOLORTYPES = {1: 0, 2: 4, 3: 2, 4: 6} #png color type for each number of bytes per pixel
+
+#generic function to read a whole drawable as a numpy array with shape (height, width, bpp)
+def getpixels(drawable):
+  w, h = drawable.width, drawable.height
+  rgn = drawable.get_pixel_rgn(0, 0, w, h, False, False)
+  return np.frombuffer(rgn[0:w, 0:h], dtype=np.uint8).reshape(h, w, drawable.bpp)
+
+#function to get the delay of a frame layer, from the "(Nms)" tag of its name or the default one
+def framedelay(layer, delay):
+  mm = DELAYTAG.search(layer.name)
+  return int(mm.group(1)) if mm is not None else delay
+
+#function to set the delay and disposal tags in the name of a frame layer, replacing the old ones
+def setframetags(layer, delay, disposal="combine"):
+  layer.name = FRAMETAGS.sub("", layer.name) + " (" + str(delay) + "ms) (" + disposal + ")"
+
+#function to get the bounding box (x, y, width, height) of the pixels differing in two arrays, None if they are equal
+def changedbox(prev, cur):
+  diff = (prev != cur).any(axis=2)
+  rows = np.flatnonzero(diff.any(axis=1))
+  if len(rows) == 0:
+    return None
+  cols = np.flatnonzero(diff.any(axis=0))
+  return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
+
+#function to reduce the frames of an animation: frames equal to the previous one are removed, extending its delay,
+#the other frames are cropped to the rectangle changed from the previous frame, to be combined with it
+def diffframes(img, delay, crop=True):
+  '''Remove the duplicated frames and crop each frame to the area changed from the previous one. Frames are the layers from
+  the bottom to the top, the disposal tag of a frame tells how the next one is drawn: "(combine)" when the next frame is
+  cropped, "(replace)" when it is whole. Only full size layers are compared and only one frame at a time is kept in memory.
+  A frame with transparent pixels in the changed area is kept whole, since combining it would show the previous frame.
+  With 'crop' False the frames are only compared to remove the duplicated ones, and are all kept whole.
+  '''
+  frames = img.layers[::-1]
+  prev = None
+  prevlayer = None
+  prevdelay = 0
+  for ll in frames:
+    ldelay = framedelay(ll, delay)
+    if ll.width != img.width or ll.height != img.height or ll.offsets != (0, 0):
+      cur = None
+    else:
+      cur = getpixels(ll)
+
+    combine = False
+    if prev is not None and cur is not None and prev.shape == cur.shape:
+      box = changedbox(prev, cur)
+      if box is None:
+        #duplicated frame, its time is given to the previous one
+        prevdelay += ldelay
+        pdb.gimp_image_remove_layer(img, ll)
+        continue
+
+      bx, by, bw, bh = box
+      if crop and (not ll.has_alpha or cur[by:by+bh, bx:bx+bw, -1].min() == 255):
+        pdb.gimp_layer_resize(ll, bw, bh, -bx, -by)
+        combine = True
+
+    if prevlayer is not None:
+      setframetags(prevlayer, prevdelay, "combine" if combine else "replace")
+    prev = cur
+    prevlayer = ll
+    prevdelay = ldelay
+
+  if prevlayer is not None:
+    setframetags(prevlayer, prevdelay, "replace")
+
+#function to compute a palette with ncolors colors from a sample of the frames, get the palette name
+def globalpalette(img, ncolors, samples=PALETTESAMPLES):
+  step = max(1, len(img.layers) // samples)
+  sampleimg = pdb.gimp_image_new(img.width, img.height, img.base_type)
+  for ll in img.layers[::step][:samples]:
+    copylayer = pdb.gimp_layer_new_from_drawable(ll, sampleimg)
+    sampleimg.add_layer(copylayer, 0)
+
+  pdb.gimp_image_convert_indexed(sampleimg, 0, 0, ncolors, False, True, "ignored")
+  ncmap, cmap = pdb.gimp_image_get_colormap(sampleimg)
+  pdb.gimp_image_delete(sampleimg)
+
+  palname = pdb.gimp_palette_new("animation export")
+  for i in range(0, ncmap, 3):
+    pdb.gimp_palette_add_entry(palname, "", tuple(cmap[i:i+3]))
+  return palname
+
+#function to export the layers of an image as an animated gif, leaving the image untouched
+def exportgif(img, filename, delay, ncolors=256, dither=False, samples=PALETTESAMPLES):
+  '''Save the layers of the image as the frames of an animated gif. A copy of the image is converted to indexed mode with
+  one palette computed on a sample of the frames, instead of the whole stack. When numpy is available, duplicated frames
+  are merged extending their delay. Without 'dither' the other frames are saved as the changed rectangle only: dithering
+  the frames independently changes the pixels outside that rectangle too, so with 'dither' the frames are saved whole.
+  '''
+  expimg = pdb.gimp_image_duplicate(img)
+  palname = None
+  try:
+    if (expimg.base_type != INDEXED and len(expimg.layers) > samples):
+      palname = globalpalette(expimg, ncolors, samples)
+
+    if np is not None:
+      diffframes(expimg, delay, not dither)
+
+    if (palname is not None):
+      pdb.gimp_image_convert_indexed(expimg, int(dither), 4, 0, False, False, palname) #4 = custom palette
+    elif (expimg.base_type != INDEXED):
+      pdb.gimp_image_convert_indexed(expimg, int(dither), 0, ncolors, False, False, "ignored")
+
+    pdb.file_gif_save(expimg, expimg.layers[0], filename, filename, 0, 1, delay, 0)
+  finally:
+    if (palname is not None):
+      pdb.gimp_palette_delete(palname)
+    pdb.gimp_image_delete(expimg)
+
+
+#class to write an animated png one frame at a time
+class APNGWriter:
+  '''Streaming writer of animated png files, needing only zlib and struct. Frames are numpy arrays (height, width, bpp),
+  appended one at a time with their delay and written as soon as the following frame is known: only the last frame is
+  kept in memory. A frame equal to the previous one extends its delay, the other frames store only the rectangle changed
+  from the previous frame. Frames without alpha get an opaque alpha channel if the file has one.
+  '''
+  #constructor
+  def __init__(self, filename, width, height, bpp, loops=0, compression=6):
+    if np is None:
+      raise RuntimeError("Error! numpy module is needed to write animated png files.")
+    self.width = width
+    self.height = height
+    self.bpp = bpp
+    self.loops = loops
+    self.compression = compression
+    self.nframes = 0
+    self.seqnum = 0
+    self.last = None #last frame appended
+    self.pending = None #(box, delay) of the last frame, still to be written
+    self.fpng = open(filename, "wb")
+    self.fpng.write("\x89PNG\r\n\x1a\n")
+    self.writechunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, PNGCOLORTYPES[bpp], 0, 0, 0))
+    self.actlpos = self.fpng.tell()
+    self.writechunk("acTL", struct.pack(">II", 0, loops)) #the number of frames is set on closing
+
+  #method, write a chunk of the png file
+  def writechunk(self, ctype, data):
+    self.fpng.write(struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data) & 0xffffffff))
+
+  #method, add a frame showed for 'delay' milliseconds
+  def append(self, pix, delay):
+    if pix.shape[2] == self.bpp - 1:
+      pix = np.concatenate((pix, np.full(pix.shape[:2] + (1,), 255, dtype=pix.dtype)), axis=2)
+    pix = np.around(np.clip(pix, 0, 255)).astype(np.uint8) if pix.dtype != np.uint8 else pix
+    if pix.shape != (self.height, self.width, self.bpp):
+      raise ValueError("Frame of shape " + str(pix.shape) + " in an animation of " + str((self.height, self.width, self.bpp)))
+
+    if self.last is None:
+      box = (0, 0, self.width, self.height)
+    else:
+      box = changedbox(self.last, pix)
+      if box is None:
+        self.pending = (self.pending[0], self.pending[1] + delay)
+        return
+
+    self.flushframe()
+    self.last = pix
+    self.pending = (box, delay)
+
+  #method, write the pending frame
+  def flushframe(self):
+    if self.pending is None:
+      return
+    (bx, by, bw, bh), delay = self.pending
+    #fcTL: sequence, size, offsets, delay (numerator, denominator), dispose op 0 (none), blend op 0 (source)
+    self.writechunk("fcTL", struct.pack(">IIIIIHHBB", self.seqnum, bw, bh, bx, by, min(delay, 65535), 1000, 0, 0))
+    self.seqnum += 1
+
+    #rows with the up filter (type 2): difference with the previous row
+    rect = self.last[by:by+bh, bx:bx+bw].reshape(bh, bw * self.bpp)
+    rows = np.empty((bh, bw * self.bpp + 1), dtype=np.uint8)
+    rows[:, 0] = 2
+    rows[0, 1:] = rect[0]
+    rows[1:, 1:] = rect[1:] - rect[:-1]
+    data = zlib.compress(rows.tostring(), self.compression)
+    if self.nframes == 0:
+      self.writechunk("IDAT", data)
+    else:
+      self.writechunk("fdAT", struct.pack(">I", self.seqnum) + data)
+      self.seqnum += 1
+    self.nframes += 1
+    self.pending = None
+
+  #method, write the last frame, the number of frames and close the file
+  def close(self):
+    self.flushframe()
+    self.writechunk("IEND", "")
+    self.fpng.seek(self.actlpos)
+    self.writechunk("acTL", struct.pack(">II", self.nframes, self.loops))
+    self.fpng.close()
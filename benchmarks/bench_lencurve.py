@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_lencurve.py
+#
+#  Copyright 2018 Valentino Esposito <valentinoe85@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+#This script compares speed and accuracy of the methods used by CompBezierCurve.lencurve in text_along_path.py
+#It is not a plug-in: run it with python 2 outside GIMP, e.g. python benchmarks/bench_lencurve.py
+#The CompBezierCurve class and the module level definitions are read from text_along_path.py without importing gimpfu.
+
+import sys
+import os
+import ast
+import math
+import time
+
+TAPFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "text_along_path.py")
+REPEAT = 20
+
+#load the CompBezierCurve class skipping the gimpfu import and the plug-in registration
+def loadcbcclass(filename):
+  tree = ast.parse(open(filename).read(), filename)
+  keep = []
+  for node in tree.body:
+    if isinstance(node, ast.ImportFrom) and node.module == "gimpfu":
+      continue
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.TryExcept, ast.Assign)) or \
+      (isinstance(node, ast.ClassDef) and node.name == "CompBezierCurve"):
+      keep.append(node)
+  modns = {}
+  exec compile(ast.Module(body=keep), filename, "exec") in modns
+  return modns["CompBezierCurve"]
+
+#control points of some curves similar to the ones of glyph outlines: arcs, S bends, tight turns and straight strokes
+def glyphcurves():
+  kappa = 0.5522847498
+  res = {}
+  circle = []
+  for k in range(5):
+    ang = k * math.pi / 2.0
+    cx = 30 * math.cos(ang)
+    cy = 30 * math.sin(ang)
+    tx = -30 * kappa * math.sin(ang)
+    ty = 30 * kappa * math.cos(ang)
+    circle.extend([cx - tx, cy - ty, cx, cy, cx + tx, cy + ty])
+  res["bowl (o)"] = circle
+  res["S bend (s)"] = [0, 0, 0, 0, 25, -10, 0, 40, 20, 35, 45, 30, 5, 65, 25, 75, 25, 75]
+  res["tight turn (r)"] = [0, 0, 0, 0, 2, -18, 20, -20, 3, -22, 3, -22]
+  res["stem (l)"] = [0, 0, 0, 0, 0, 20, 0, 50, 0, 70, 0, 70]
+  return res
+
+#reference length independent from the measured methods: sum of the chords of a dense polyline, refined with Richardson
+#extrapolation (the chord sum error goes as the square of the step). pts is the flat control point list of glyphcurves
+def reflength(pts, nchords=1 << 14):
+  def polylen(ax, ay, bx, by, cx, cy, dx, dy, n):
+    res = 0.0
+    px, py = ax, ay
+    for k in range(1, n + 1):
+      t = float(k) / n
+      s = 1.0 - t
+      x = s*s*s*ax + 3*s*s*t*bx + 3*s*t*t*cx + t*t*t*dx
+      y = s*s*s*ay + 3*s*s*t*by + 3*s*t*t*cy + t*t*t*dy
+      res += math.hypot(x - px, y - py)
+      px, py = x, y
+    return res
+
+  total = 0.0
+  for i in range(0, len(pts) - 6, 6):
+    seg = pts[i+2:i+6] + pts[i+6:i+10]
+    total += (4.0 * polylen(*(seg + [nchords])) - polylen(*(seg + [nchords // 2]))) / 3.0
+  return total
+
+def timeit(func):
+  t0 = time.time()
+  for r in range(REPEAT):
+    res = func()
+  return res, (time.time() - t0) / REPEAT
+
+def main():
+  CompBezierCurve = loadcbcclass(TAPFILE)
+  cases = [("split", 1, 10), ("split", 0.01, 20), ("gauss", 1, 10), ("gauss", 0.01, 20)]
+  print "%-16s %-8s %-9s %14s %12s %12s" % ("curve", "method", "precision", "length", "abs error", "time (ms)")
+  for name, pts in sorted(glyphcurves().items()):
+    cbc = CompBezierCurve(*pts)
+    reflen = reflength(pts)
+    for method, prec, maxiter in cases:
+      try:
+        ll, tt = timeit(lambda: cbc.lenfullcurve(prec, maxiter, method))
+      except RuntimeError:
+        print "%-16s %-8s %-9s %14s" % (name, method, prec, "max iterations reached")
+        continue
+      print "%-16s %-8s %-9s %14.6f %12.2e %12.3f" % (name, method, prec, ll, abs(ll - reflen), tt * 1000)
+
+
+if __name__ == "__main__":
+  main()
@@ -28,15 +28,100 @@
 
 import sys
 import os
+import math
 import gtk
 import gobject
 from gimpfu import *
+from animation_export import exportgif, APNGWriter
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 BLURSTEPS = 10
 BLURDIR = ["left", "top-left", "top", "top-right", "right", "bottom-right", "bottom", "bottom-left"]
 DEFBLURDIR = 0
 FRAMETIME = 100
 BIDIRBLUR = False
+BLURSTEPLEN = 5 #blur length added at each step (pixels)
+
+#generic function to read a whole drawable as a numpy array with shape (height, width, bpp)
+def getpixels(drawable):
+  w, h = drawable.width, drawable.height
+  rgn = drawable.get_pixel_rgn(0, 0, w, h, False, False)
+  return np.frombuffer(rgn[0:w, 0:h], dtype=np.uint8).reshape(h, w, drawable.bpp).astype(np.float32)
+
+#generic function to write a numpy array with shape (height, width, bpp) on a whole drawable
+def setpixels(drawable, pix):
+  w, h = drawable.width, drawable.height
+  rgn = drawable.get_pixel_rgn(0, 0, w, h, True, True)
+  rgn[0:w, 0:h] = np.around(np.clip(pix, 0, 255)).astype(np.uint8).tostring()
+  drawable.flush()
+  drawable.merge_shadow(True)
+  drawable.update(0, 0, w, h)
+
+#function to composite the pixels 'top' over the pixels 'bottom', as merging down a layer, the result has the channels of bottom
+def overpixels(top, bottom, topalpha, bottomalpha):
+  nc = bottom.shape[2] - int(bottomalpha)
+  ab = bottom[:, :, nc:] / 255.0 if bottomalpha else 1.0
+  at = top[:, :, -1:] / 255.0 if topalpha else 1.0
+  outa = at + ab * (1.0 - at)
+  col = (top[:, :, :nc] * at + bottom[:, :, :nc] * ab * (1.0 - at)) / np.maximum(outa, 1e-6)
+  if bottomalpha:
+    return np.concatenate((col, outa * 255.0), axis=2)
+  return col
+
+#function to blur pixels along a direction, with lengths growing step by step, yielding the blurred pixels for each length
+def progressiveblur(pix, hasalpha, blurdir, lengths):
+  '''Linear motion blur of the pixels (height, width, bpp): each pixel becomes the average of the pixels met moving from it
+  along the direction blurdir (an index of BLURDIR, 45 degrees each) for the given length, like plug_in_mblur does.
+  The blur of each length is obtained from the previous one adding the new pixels to a running sum, so the total work
+  is linear in the max length. Pixels beyond the borders repeat the border ones, colors are averaged weighted by alpha.
+  '''
+  ang = math.radians(blurdir * 45)
+  dx = int(round(math.cos(ang)))
+  dy = int(round(math.sin(ang)))
+  steplen = math.hypot(dx, dy)
+  taps = [int(round(ll / steplen)) for ll in lengths]
+
+  hh, ww = pix.shape[:2]
+  prem = pix.astype(np.float32)
+  if hasalpha:
+    prem[:, :, :-1] *= prem[:, :, -1:] / 255.0
+  mm = max(taps + [0])
+  pad = np.pad(prem, ((mm, mm), (mm, mm), (0, 0)), mode="edge")
+
+  acc = prem.copy()
+  n = 0
+  for nt in taps:
+    while n < nt:
+      n += 1
+      acc += pad[mm + n*dy:mm + n*dy + hh, mm + n*dx:mm + n*dx + ww]
+    res = acc / (n + 1)
+    if hasalpha:
+      res[:, :, :-1] *= 255.0 / np.maximum(res[:, :, -1:], 1e-6)
+    yield res
+
+#function to get the frames of the blurring animation, first the unblurred one, as pixel arrays
+def blurframes(refpix, refalpha, bgpix, bgalpha, blurdir, numsteps, bidir):
+  '''Yield the frames of the animation: the reference pixels blurred with lengths 0, BLURSTEPLEN, 2 * BLURSTEPLEN...
+  With bidir the blur in the opposite direction is merged over the first one, as the layer based animation does.
+  If bgpix is not None, each frame is merged over the background pixels.
+  '''
+  lengths = [BLURSTEPLEN * i for i in range(numsteps)]
+  blurs = progressiveblur(refpix, refalpha, blurdir, lengths)
+  if bidir:
+    opposite = progressiveblur(refpix, refalpha, (blurdir + 4) % len(BLURDIR), lengths)
+  for i in range(numsteps):
+    frame = blurs.next()
+    if bidir and i > 0:
+      frame = overpixels(opposite.next(), frame, refalpha, refalpha)
+    elif bidir:
+      opposite.next()
+    if bgpix is not None:
+      frame = overpixels(frame, bgpix, refalpha, bgalpha)
+    yield frame
 
 #Class for the customized secondary dialog interface (using gtk as GUI)
 class AskDialog(gtk.Dialog):
@@ -87,6 +172,7 @@ class MainWin(gtk.Window):
     self.savepath = os.getcwd() #will be updated by user choice
     self.frametime = FRAMETIME
     self.bidblur = BIDIRBLUR
+    self.stream = False
 
     #Obey the window manager quit signal:
     self.connect("destroy", gtk.main_quit)
@@ -153,6 +239,14 @@ class MainWin(gtk.Window):
     butch.set_active(BIDIRBLUR)
     butch.connect("toggled", self.on_butch_toggled)
     
+    butstr = gtk.CheckButton("Write the frames directly to an animated png (no frame layers)")
+    vbx.add(butstr)
+    butstr.set_active(self.stream)
+    butstr.connect("toggled", self.on_butstr_toggled)
+    if self.localerror() is not None:
+      butstr.set_sensitive(False)
+      butstr.set_tooltip_text(self.localerror())
+    
     butok = gtk.Button("OK")
     vbx.add(butok)
     butok.connect("clicked", self.on_butok_clicked)
@@ -178,6 +272,36 @@ class MainWin(gtk.Window):
   def on_butch_toggled(self, widget):
     self.bidblur = widget.get_active()
     
+  #callback method, setting if the frames are written to an animated png instead of layers
+  def on_butstr_toggled(self, widget):
+    self.stream = widget.get_active()
+
+  #method, get the reason why the blur cannot be computed on the layer pixels (needed to write the frames directly
+  #to an animated png), None if it can
+  def localerror(self):
+    if np is None:
+      return "Writing the frames directly to an animated png needs the numpy module."
+    if len(self.img.layers) == 2:
+      lya, lyb = self.img.layers[0], self.img.layers[1]
+      if lya.width != lyb.width or lya.height != lyb.height or lya.offsets != lyb.offsets:
+        return "Writing the frames directly to an animated png needs the two layers to have the same size and position."
+    return None
+    
+  #method to choose the name of the file to save, get None if no file is chosen
+  def choosefile(self, name, mime):
+    ffilter = gtk.FileFilter()
+    ffilter.set_name(name)
+    ffilter.add_mime_type(mime)
+    filechooser = gtk.FileChooserDialog(title="Choose file", parent=self, action=gtk.FILE_CHOOSER_ACTION_SAVE, buttons=None, backend=None)
+    filechooser.add_filter(ffilter)
+    filechooser.add_button("Cancel", gtk.RESPONSE_CANCEL)
+    filechooser.add_button("Save", gtk.RESPONSE_OK)
+
+    respfc = filechooser.run()
+    res = filechooser.get_filename() if respfc == gtk.RESPONSE_OK else None
+    filechooser.destroy()
+    return res
+    
   #callback method, do the blurring and optionally export the gif
   def on_butok_clicked(self, widget):
     if (len(self.img.layers) > 2):
@@ -195,17 +319,50 @@ class MainWin(gtk.Window):
         refbglayer = self.img.layers[1]
         mergbg = True
       
+      #blurring the local pixels, only if the layers cover the same area
+      localblur = self.localerror() is None
+      if (self.stream and not localblur):
+        pdb.gimp_message(self.localerror() + " The frames will be created as layers.")
+      if localblur:
+        refpix = getpixels(refblurlayer)
+        bgpix = getpixels(refbglayer) if mergbg else None
+        frames = blurframes(refpix, refblurlayer.has_alpha, bgpix, mergbg and refbglayer.has_alpha, self.blurdir, int(self.numblursteps), self.bidblur)
+
+      #writing the frames to file without creating layers, if requested
+      if (localblur and self.stream):
+        savepath = self.choosefile("Animated Portable Network Graphics (png)", "image/png")
+        if (savepath is not None):
+          self.savepath = savepath
+          framelayer = refbglayer if mergbg else refblurlayer
+          writer = APNGWriter(self.savepath, framelayer.width, framelayer.height, framelayer.bpp)
+          try:
+            for frame in frames:
+              writer.append(frame, int(self.frametime))
+          finally:
+            writer.close()
+        return
+
       #creating the layers with different blurring
+      if localblur:
+        frames.next() #the unblurred frame is the reference layer itself
       for i in range(1, int(self.numblursteps)):
+        if localblur:
+          framelayer = refbglayer if mergbg else refblurlayer
+          blurlayer = pdb.gimp_layer_new(self.img, framelayer.width, framelayer.height, framelayer.type, refblurlayer.name + "_" + str(i), 100, LAYER_MODE_NORMAL)
+          self.img.add_layer(blurlayer, 0)
+          blurlayer.set_offsets(*framelayer.offsets)
+          setpixels(blurlayer, frames.next())
+          continue
+
         blurlayer = refblurlayer.copy()
         self.img.add_layer(blurlayer, 0)
-        pdb.plug_in_mblur(self.img, blurlayer, 0, 5*i, blrang, 0, 0)
+        pdb.plug_in_mblur(self.img, blurlayer, 0, BLURSTEPLEN*i, blrang, 0, 0)
         
         #performing bidirectional blurring
         if (self.bidblur):
           bilayer = refblurlayer.copy()
           self.img.add_layer(bilayer, 0)
-          pdb.plug_in_mblur(self.img, bilayer, 0, 5*i, (blrang + 180), 0, 0)
+          pdb.plug_in_mblur(self.img, bilayer, 0, BLURSTEPLEN*i, (blrang + 180), 0, 0)
           blurlayer = pdb.gimp_image_merge_down(self.img, bilayer, 0)
 
         #merging with background image if present
@@ -228,22 +385,11 @@ class MainWin(gtk.Window):
       
       #asking if the gif should be exported now
       if (dial.answer):
-        #creating the file chooser dialog
-        ffilter = gtk.FileFilter()
-        ffilter.set_name("Animated Graphic Interface Format (gif)")
-        ffilter.add_mime_type("image/gif")
-        filechooser = gtk.FileChooserDialog(title="Choose file", parent=self, action=gtk.FILE_CHOOSER_ACTION_SAVE, buttons=None, backend=None)
-        filechooser.add_filter(ffilter)
-        filechooser.add_button("Cancel", gtk.RESPONSE_CANCEL)
-        filechooser.add_button("Save", gtk.RESPONSE_OK)
-        
-        respfc = filechooser.run()
-
-        #export the animated gif      
-        if (respfc == gtk.RESPONSE_OK):
-          self.savepath = filechooser.get_filename()        
-          pdb.gimp_image_convert_indexed(self.img, 0, 0, 100, False, False, "ignored")
-          pdb.file_gif_save(self.img, self.img.layers[0], self.savepath, self.savepath, 0, 1, self.frametime, 0)
+        #export the animated gif
+        savepath = self.choosefile("Animated Graphic Interface Format (gif)", "image/gif")
+        if (savepath is not None):
+          self.savepath = savepath
+          exportgif(self.img, self.savepath, int(self.frametime), 100)
 
       dial.destroy()
 
@@ -30,13 +30,21 @@ import sys
 import os
 import math
 import random
+import multiprocessing
 import gtk
 import gobject
 from gimpfu import *
+from animation_export import exportgif, APNGWriter
+from snow_simulation import SnowField, simulatesnow, savestates, loadstates
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 COVERAGE = 10 #a percentage
-FRAGMENTATION = ["low", "medium", "high"]
-DEFFRAGM = [10, 30, 60]
+FRAGMENTATION = ["low", "medium", "high", "very high", "extreme"]
+DEFFRAGM = [10, 30, 60, 1000, 20000]
 DIRECTIONS = ["down", "right", "top", "left"]
 DEFDIRECTION = 0
 SPEEDS = ["slow", "medium", "fast"]
@@ -44,6 +52,10 @@ DEFSPEED = [2, 5, 10]
 OBSCIINT = ["null", "weak", "medium", "strong"]
 DEFOBSCIINT = [0, 1, 3, 6]
 TIME = 1
+SEED = -1 #a negative seed means a random one
+FLAKEHARDNESS = 0.25 #the hardness of the '2. Hardness 025' brush, used to render the flakes
+SPLATCHUNK = 1 << 22 #max number of brush pixels computed at once when rendering the flakes
+FRAMEBATCH = 2 #frames read and rendered together for each worker
 
 #generic function used to adjust RGB color
 def gdkcoltorgb(gdkc):
@@ -52,6 +64,103 @@ def gdkcoltorgb(gdkc):
   blue = int(gdkc.blue_float * 255)
   return (red, green, blue)
 
+#generic function to read a region of a drawable as a numpy array with shape (height, width, bpp)
+def getpixels(drawable, x, y, w, h):
+  rgn = drawable.get_pixel_rgn(x, y, w, h, False, False)
+  return np.frombuffer(rgn[x:x+w, y:y+h], dtype=np.uint8).reshape(h, w, drawable.bpp).astype(np.float32)
+
+#generic function to write a numpy array with shape (height, width, bpp) in a region of a drawable
+def setpixels(drawable, x, y, pix):
+  h, w = pix.shape[:2]
+  rgn = drawable.get_pixel_rgn(x, y, w, h, True, True)
+  rgn[x:x+w, y:y+h] = np.around(np.clip(pix, 0, 255)).astype(np.uint8).tostring()
+
+#function to compute the coverage (height, width) of soft discs of diameter 'size' centered in (x, y).
+#The profile is the one of GIMP generated brushes: 1 - (d / radius)^(0.4 / (1 - hardness)).
+#Overlapping discs are combined as the paintbrush would do stamping them one over the other
+def splatflakes(width, height, size, x, y, hardness=FLAKEHARDNESS):
+  if len(size) == 0:
+    return np.zeros((height, width))
+
+  expo = 0.2 / (1.0 - hardness) #half exponent, applied to the squared distance
+  logcov = np.zeros(width * height)
+  rad = 0.5 * np.asarray(size, dtype=np.float64)
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
+  side = 2 * int(math.ceil(rad.max())) + 2
+  grid = np.arange(side)
+  chunk = max(1, SPLATCHUNK // (side * side))
+  for i in range(0, len(rad), chunk):
+    cr = rad[i:i+chunk, np.newaxis]
+    px = np.floor(x[i:i+chunk] - rad.max()).astype(int)[:, np.newaxis] + grid
+    py = np.floor(y[i:i+chunk] - rad.max()).astype(int)[:, np.newaxis] + grid
+    dx2 = ((px + 0.5 - x[i:i+chunk, np.newaxis]) / cr) ** 2
+    dy2 = ((py + 0.5 - y[i:i+chunk, np.newaxis]) / cr) ** 2
+    dd = dx2[:, np.newaxis, :] + dy2[:, :, np.newaxis] #shape (flakes, side, side), squared distance in radius units
+    inside = (dd < 1.0) & ((px >= 0) & (px < width))[:, np.newaxis, :] & ((py >= 0) & (py < height))[:, :, np.newaxis]
+    alpha = np.minimum(1.0 - (dd[inside] ** expo), 1.0 - (1.0 / 1024))
+    idx = (py[:, :, np.newaxis] * width + px[:, np.newaxis, :])[inside]
+    logcov += np.bincount(idx, weights=np.log1p(-alpha), minlength=width * height)
+
+  return -np.expm1(logcov).reshape(height, width)
+
+#function to paint with 'color' the coverage 'cov' (height, width) over the pixels 'pix' (height, width, bpp) of an RGB(A) drawable
+def paintcoverage(pix, cov, color):
+  col = np.asarray(color[:3], dtype=np.float32)
+  cov = cov[:, :, np.newaxis].astype(np.float32)
+  if pix.shape[2] == 4:
+    dsta = pix[:, :, 3:] / 255.0
+    outa = dsta + cov * (1.0 - dsta)
+    rgb = (pix[:, :, :3] * dsta * (1.0 - cov) + col * cov) / np.maximum(outa, 1e-6)
+    return np.concatenate((rgb, outa * 255.0), axis=2)
+  else:
+    return pix * (1.0 - cov) + col * cov
+
+#data shared with the processes rendering the frames, set before the pool is created
+_framedata = {}
+
+#function rendering a frame job (index, pixels, x offset, y offset) with the flake states in _framedata
+def renderframejob(job):
+  i, pix, ox, oy = job
+  hh, ww = pix.shape[:2]
+  cov = splatflakes(ww, hh, _framedata["r"], _framedata["xs"][i] - ox, _framedata["ys"][i] - oy) * _framedata["opacity"]
+  res = paintcoverage(pix.astype(np.float32), cov, _framedata["color"])
+  return np.around(np.clip(res, 0, 255)).astype(np.uint8)
+
+#function to draw the flakes on the frame layers, from the precomputed flake states
+def renderframes(layers, r, xs, ys, color, opacity, workers=0):
+  '''Draw on each RGB(A) layer of the list the flakes of radii r at the coordinates xs[i], ys[i], one row for each layer.
+  Frames are independent: the layer pixels are read in batches, rendered in a pool of processes (only where processes
+  can be forked) and written back in order, each layer with one pixel region.
+  '''
+  if workers < 1:
+    workers = multiprocessing.cpu_count()
+  _framedata.update({"r": r, "xs": xs, "ys": ys, "color": color, "opacity": opacity})
+  pool = None
+  if workers > 1 and len(layers) > 1 and os.name == "posix":
+    pool = multiprocessing.Pool(min(workers, len(layers)))
+
+  try:
+    batch = workers * FRAMEBATCH
+    for b in range(0, len(layers), batch):
+      jobs = []
+      for i, ll in enumerate(layers[b:b+batch], b):
+        ox, oy = ll.offsets
+        jobs.append((i, getpixels(ll, 0, 0, ll.width, ll.height).astype(np.uint8), ox, oy))
+
+      results = pool.imap(renderframejob, jobs) if pool is not None else (renderframejob(jj) for jj in jobs)
+      for i, res in enumerate(results, b):
+        ll = layers[i]
+        setpixels(ll, 0, 0, res)
+        ll.flush()
+        ll.merge_shadow(True)
+        ll.update(0, 0, ll.width, ll.height)
+        gimp.progress_update(float(i+1)/len(layers))
+  finally:
+    if pool is not None:
+      pool.terminate()
+    _framedata.clear()
+
 
 #class holding information on a single flake
 class SnowFlake:
@@ -76,6 +185,18 @@ class SnowFlake:
     self.y = self.y + vy
 
 
+#function to create the frame layers copying the base layer, if the image has only one layer
+def makeframelayers(img, nframes):
+  if (len(img.layers) == 1):
+    baselayer = img.layers[0]
+    bname = baselayer.name
+    for i in range(1, nframes):
+      copylayer = baselayer.copy()
+      img.add_layer(copylayer, 0)
+      copylayer.name = bname + "_" + str(i)
+      copylayer.flush()
+
+
 #Class for the customized GUI
 class MainApp(gtk.Window):
   #constructor
@@ -93,6 +214,9 @@ class MainApp(gtk.Window):
     self.pn = 0 #will be reinitialized in GUI costruction
     self.sncol = gtk.gdk.Color(65535, 65535, 65535) #initialized to white
     self.time = TIME * 10.0
+    self.seed = SEED
+    self.statesfile = "" #no states file is saved if empty
+    self.stream = False
     self.savepath = os.getcwd() #will be updated by user choice
 
     #Obey the window manager quit signal:
@@ -235,6 +359,38 @@ class MainApp(gtk.Window):
     spbutg.connect("output", self.on_time_change)
     hbxg.add(spbutg)
 
+    #new row
+    hbxh = gtk.HBox(spacing=10, homogeneous=True)
+    vbx.add(hbxh)
+    
+    labh = gtk.Label("Random seed (-1 for a random one)")
+    hbxh.add(labh)
+    
+    buthadj = gtk.Adjustment(SEED, -1, 2**31 - 1, 1, 100)
+    spbuth = gtk.SpinButton(buthadj, 0, 0)
+    spbuth.connect("output", self.on_seed_change)
+    hbxh.add(spbuth)
+
+    #new row
+    hbxi = gtk.HBox(spacing=10, homogeneous=True)
+    vbx.add(hbxi)
+    
+    labi = gtk.Label("Save flake states to (.npz, optional)")
+    hbxi.add(labi)
+    
+    entri = gtk.Entry()
+    entri.connect("changed", self.on_statesfile_change)
+    hbxi.add(entri)
+
+    #new row
+    butstr = gtk.CheckButton("Write the frames directly to an animated png (no frame layers)")
+    vbx.add(butstr)
+    butstr.set_active(self.stream)
+    butstr.connect("toggled", self.on_stream_toggled)
+    if self.streamerror() is not None:
+      butstr.set_sensitive(False)
+      butstr.set_tooltip_text(self.streamerror())
+
     #new row
     butok = gtk.Button("OK")
     vbx.add(butok)
@@ -274,6 +430,26 @@ class MainApp(gtk.Window):
   #callback method, setting the animation time (frame numbers)
   def on_time_change(self, widget):
     self.time = widget.get_value() * 10.0 #each frame is 0.1 seconds
+
+  #callback method, setting the random seed
+  def on_seed_change(self, widget):
+    self.seed = int(widget.get_value())
+
+  #callback method, setting the file where the flake states are saved
+  def on_statesfile_change(self, widget):
+    self.statesfile = widget.get_text()
+
+  #callback method, setting if the frames are written to an animated png instead of layers
+  def on_stream_toggled(self, widget):
+    self.stream = widget.get_active()
+
+  #method, get the reason why the frames cannot be written directly to an animated png, None if they can
+  def streamerror(self):
+    if np is None:
+      return "Writing the frames directly to an animated png needs the numpy module."
+    if self.img.base_type != RGB or len(self.img.layers) != 1:
+      return "Writing the frames directly to an animated png needs an RGB image with a single layer."
+    return None
   
   #callback method, do the animation
   def on_butok_clicked(self, widget):
@@ -291,29 +467,62 @@ class MainApp(gtk.Window):
     covarea = imarea * (self.cover/100)
     porad = math.sqrt((covarea / self.pn) / math.pi) #radius of a circle
     
-    #initializing the flake list
-    flakes = [None] * self.pn
-    for i in range(self.pn):
-      rx = random.uniform(1, ww)
-      ry = random.uniform(1, hh)
-      npr = porad * (1 + (0.5 * random.random()))
-      fl = SnowFlake(npr, rx, ry)
-      flakes[i] = fl
-    
+    #initializing the flakes
+    if np is not None:
+      flakes = SnowField(self.pn, porad, ww, hh, np.random.RandomState(self.seed if self.seed >= 0 else None))
+    else:
+      if self.seed >= 0:
+        random.seed(self.seed)
+      flakes = [None] * self.pn
+      for i in range(self.pn):
+        rx = random.uniform(1, ww)
+        ry = random.uniform(1, hh)
+        npr = porad * (1 + (0.5 * random.random()))
+        fl = SnowFlake(npr, rx, ry)
+        flakes[i] = fl
+    
+    #writing the frames to a file without creating layers, if requested and possible
+    if self.stream and self.streamerror() is not None:
+      pdb.gimp_message(self.streamerror() + " The frames will be created as layers.")
+    elif self.stream:
+      ffilter = gtk.FileFilter()
+      ffilter.set_name("Animated Portable Network Graphics (png)")
+      ffilter.add_mime_type("image/png")
+      filechooser = gtk.FileChooserDialog(title="Choose file", parent=self, action=gtk.FILE_CHOOSER_ACTION_SAVE, buttons=None, backend=None)
+      filechooser.add_filter(ffilter)
+      filechooser.add_button("Cancel", gtk.RESPONSE_CANCEL)
+      filechooser.add_button("Save", gtk.RESPONSE_OK)
+
+      if (filechooser.run() == gtk.RESPONSE_OK):
+        self.savepath = filechooser.get_filename()
+        self.streamframes(flakes, self.savepath)
+      filechooser.destroy()
+      pdb.gimp_context_set_foreground(oldfgcol)
+      pdb.gimp_context_get_brush(oldbrush)
+      return
+
     #creating the layer copies if there is only one layer
-    if (len(self.img.layers) == 1):
-      baselayer = self.img.layers[0]
-      bname = baselayer.name
-      for i in range(1, int(self.time)):
-        copylayer = baselayer.copy()
-        self.img.add_layer(copylayer, 0)
-        copylayer.name = bname + "_" + str(i)
-        copylayer.flush()
+    makeframelayers(self.img, int(self.time))
     
     #drawing the flakes on top of each layer
-    for ll in self.img.layers[::-1]: #this reverses the list
-      self.drawflakes(ll, flakes)
-      self.moveflakes(flakes)
+    layers = self.img.layers[::-1] #this reverses the list
+    if np is not None and self.img.base_type == RGB:
+      xs, ys = flakes.simulate(len(layers), self.direc, *self.getspeeds())
+      if self.statesfile:
+        savestates(self.statesfile, flakes.r, xs, ys)
+      renderframes(layers, flakes.r, xs, ys, gdkcoltorgb(self.sncol), pdb.gimp_context_get_opacity() / 100.0)
+    elif np is not None:
+      xs, ys = flakes.simulate(len(layers), self.direc, *self.getspeeds())
+      if self.statesfile:
+        savestates(self.statesfile, flakes.r, xs, ys)
+      for i, ll in enumerate(layers):
+        self.drawflakes(ll, list(zip(flakes.r.tolist(), xs[i].tolist(), ys[i].tolist())))
+    else:
+      if self.statesfile:
+        pdb.gimp_message("Saving the flake states needs the numpy module, the states have not been saved.")
+      for ll in layers:
+        self.drawflakes(ll, [(fl.r, fl.x, fl.y) for fl in flakes])
+        self.moveflakes(flakes)
     
     pdb.gimp_displays_flush()
   
@@ -344,24 +553,56 @@ class MainApp(gtk.Window):
       if (respfc == gtk.RESPONSE_OK):
         self.savepath = filechooser.get_filename()
         
-        if (self.img.base_type != 2): #converting to indexed image only if is not already an indexed image
-          pdb.gimp_image_convert_indexed(self.img, 0, 0, 100, False, False, "ignored")
-
-        pdb.file_gif_save(self.img, self.drawab, self.savepath, self.savepath, 0, 1, 100, 0)
+        exportgif(self.img, self.savepath, 100, 100)
 
     askdi.destroy()
     pdb.gimp_context_set_foreground(oldfgcol)
     pdb.gimp_context_get_brush(oldbrush)
   
-  #method to draw on the drawable the flakes in the flake list
+  #method to render the frames one at a time on the pixels of the only layer, writing them to an animated png
+  def streamframes(self, flakes, filename):
+    baselayer = self.img.layers[0]
+    ww, hh = baselayer.width, baselayer.height
+    ox, oy = baselayer.offsets
+    base = getpixels(baselayer, 0, 0, ww, hh)
+    color = gdkcoltorgb(self.sncol)
+    opacity = pdb.gimp_context_get_opacity() / 100.0
+
+    xs, ys = flakes.simulate(int(self.time), self.direc, *self.getspeeds())
+    if self.statesfile:
+      savestates(self.statesfile, flakes.r, xs, ys)
+
+    writer = APNGWriter(filename, ww, hh, baselayer.bpp)
+    try:
+      for i in range(len(xs)):
+        cov = splatflakes(ww, hh, flakes.r, xs[i] - ox, ys[i] - oy) * opacity
+        writer.append(paintcoverage(base, cov, color), 100) #each frame is 0.1 seconds
+        gimp.progress_update(float(i+1)/len(xs))
+    finally:
+      writer.close()
+
+  #method to draw on the drawable the flakes in the flake list, a list of tuples (r, x, y)
   def drawflakes(self, drw, flakelist):
     pdb.gimp_context_set_brush('2. Hardness 025')
-    for flake in flakelist:
-      flc = flake.get_coord()
-      pdb.gimp_context_set_brush_size(flake.r)
-      pdb.gimp_paintbrush_default(drw, len(flc), flc)
+    for r, x, y in flakelist:
+      pdb.gimp_context_set_brush_size(r)
+      pdb.gimp_paintbrush_default(drw, 2, [x, y])
     
-  #method to move the flakes applying velocity
+  #method to get the speed along the motion direction and the max transverse speed (obscillations), in pixels
+  def getspeeds(self):
+    ww = pdb.gimp_image_width(self.img)
+    hh = pdb.gimp_image_height(self.img)
+
+    maxobs = int((self.obsci / 100.0) * ((ww + hh) / 2.0))
+    if (self.direc == 0):
+      pxspeed = int((self.speed / 100.0) * hh)
+    elif (self.direc in [1, 3]):
+      pxspeed = (self.speed / 100.0) * ww
+    elif (self.direc == 2):
+      pxspeed = (self.speed / 100.0) * hh
+    return pxspeed, maxobs
+
+  #method to move the flakes applying velocity, used when numpy is not available
   def moveflakes(self, flakelist):
     ww = pdb.gimp_image_width(self.img)
     hh = pdb.gimp_image_height(self.img)
@@ -415,6 +656,32 @@ def make_animation_snowing(img, tdraw):
   gtk.main()
 
 
+#The function to be registered in GIMP, rendering the flake states saved in a file from the frame 'first' on
+def render_snowing_states(img, tdraw, statesfile, first, nframes, color, workers):
+  if np is None:
+    raise RuntimeError("Rendering saved flake states requires numpy")
+  if img.base_type != RGB:
+    raise RuntimeError("Rendering saved flake states requires an RGB image")
+  if first < 0:
+    raise RuntimeError("The first frame to render must not be negative")
+  if len(img.layers) == 1 and nframes < 1:
+    raise RuntimeError("At least one frame must be rendered")
+
+  nlayers = nframes if len(img.layers) == 1 else len(img.layers)
+  r, xs, ys = loadstates(statesfile, first, nlayers)
+  if len(xs) < nlayers:
+    raise RuntimeError("The states file has " + str(first + len(xs)) + " frames, " + str(first + nlayers) + " are needed")
+
+  pdb.gimp_image_undo_group_start(img)
+  makeframelayers(img, nframes)
+  layers = img.layers[::-1]
+  gimp.progress_init("Rendering snow frames")
+  rgb = tuple(int(round(c * 255)) for c in (color.r, color.g, color.b))
+  renderframes(layers, r, xs, ys, rgb, pdb.gimp_context_get_opacity() / 100.0, workers)
+  pdb.gimp_image_undo_group_end(img)
+  pdb.gimp_displays_flush()
+
+
 #The command to register the function
 register(
   "python-fu_make_snowing",
@@ -430,6 +697,27 @@ register(
   make_animation_snowing
   )
 
+#The command to register the function
+register(
+  "python-fu-render-snowing-states",
+  "python-fu-render-snowing-states",
+  "Draw on the layers of an image the snow flakes saved by the snowing animation, starting from a given frame. Useful to resume a render or to split it in frame ranges",
+  "Valentino Esposito",
+  "Valentino Esposito",
+  "2018",
+  "<Image>/Filters/Animation/Snow from saved states",
+  "RGB*",
+  [
+    (PF_FILE, "statesfile", "The flake states file (.npz)", ""),
+    (PF_INT32, "first", "The frame drawn on the bottom layer", 0),
+    (PF_INT32, "nframes", "Number of frame layers to create if the image has one layer", 10),
+    (PF_COLOR, "color", "Snow color", (255, 255, 255)),
+    (PF_INT32, "workers", "Number of processes used to render the frames (0 for one per CPU)", 0)
+  ],
+  [],
+  render_snowing_states
+  )
+
 #The main function to activate the script
 main()
 
@@ -29,12 +29,102 @@
 import sys
 import os
 import copy
+import math
 from gimpfu import *
+from animation_export import exportgif, APNGWriter
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 defsavename = "/myanimated.gif"
+EASINGS = ["linear", "smoothstep", "cosine"]
+GIFCOLORS = 256 #number of colors of the gif palette
 
-#The function to be registered in GIMP
-def python_make_switchgif(image, tdrawable, savepath, frdelay, longtime, rescale, midstart):
+#generic function to read a whole drawable as a numpy array with shape (height, width, bpp)
+def getpixels(drawable):
+  w, h = drawable.width, drawable.height
+  rgn = drawable.get_pixel_rgn(0, 0, w, h, False, False)
+  return np.frombuffer(rgn[0:w, 0:h], dtype=np.uint8).reshape(h, w, drawable.bpp).astype(np.float32)
+
+#generic function to write a numpy array with shape (height, width, bpp) on a whole drawable
+def setpixels(drawable, pix):
+  w, h = drawable.width, drawable.height
+  rgn = drawable.get_pixel_rgn(0, 0, w, h, True, True)
+  rgn[0:w, 0:h] = np.around(np.clip(pix, 0, 255)).astype(np.uint8).tostring()
+  drawable.flush()
+  drawable.merge_shadow(True)
+  drawable.update(0, 0, w, h)
+
+#function to mix two pixel arrays (height, width, bpp) as merging down trpix with opacity 'weight' on bgpix.
+#bgalpha and tralpha tell if the last channel of the arrays is an alpha channel, the result has the channels of bgpix
+def blendpixels(bgpix, trpix, bgalpha, tralpha, weight):
+  nc = bgpix.shape[2] - int(bgalpha)
+  ab = bgpix[:, :, nc:] / 255.0 if bgalpha else 1.0
+  at = (trpix[:, :, -1:] / 255.0 if tralpha else 1.0) * weight
+  outa = at + ab * (1.0 - at)
+  col = (trpix[:, :, :nc] * at + bgpix[:, :, :nc] * ab * (1.0 - at)) / np.maximum(outa, 1e-6)
+  if bgalpha:
+    return np.concatenate((col, outa * 255.0), axis=2)
+  return col
+
+#function to get the opacity (0 - 1) of the incoming layer at each of the nsteps intermediate frames of a dissolvence
+def easingweights(nsteps, easing=0):
+  res = []
+  for i in range(1, nsteps + 1):
+    t = float(i) / (nsteps + 1)
+    if EASINGS[easing] == "smoothstep":
+      res.append(t * t * (3.0 - 2.0 * t))
+    elif EASINGS[easing] == "cosine":
+      res.append(0.5 - 0.5 * math.cos(math.pi * t))
+    else:
+      res.append(t)
+  return res
+
+#function to get the name of an intermediate frame
+def stepname(ll, weight):
+  return "ph" + str(ll) + "phase" + str(int(round(weight * 100)))
+
+#function to check if the dissolvence between two layers can be computed on their pixels
+def sameregion(lya, lyb):
+  return lya.width == lyb.width and lya.height == lyb.height and lya.offsets == lyb.offsets
+
+#function to write the animation directly to an animated png, without creating the frame layers
+def streamswitch(baselayers, savepath, frdelay, longtime, midstart, weights):
+  '''Write the same frames of the layer based animation to an animated png, rendering one frame at a time.
+  Only the pixels of the current pair and of the first layer are kept in memory. All the layers must have the same size
+  and offsets. If some layers have an alpha channel, an opaque one is given to the frames without it.
+  '''
+  ref = baselayers[0]
+  if np is None or not all(sameregion(ref, ly) for ly in baselayers):
+    errmess = "Writing an animated png needs numpy and source layers of the same size and position!"
+    pdb.gimp_message(errmess)
+    raise RuntimeError(errmess)
+
+  bpp = ref.bpp - int(ref.has_alpha) + int(any(ly.has_alpha for ly in baselayers))
+  writer = APNGWriter(savepath, ref.width, ref.height, bpp)
+  firstpix = getpixels(ref)
+  bgpix = firstpix
+  try:
+    for ll in range(len(baselayers)):
+      bglayer = baselayers[ll]
+      trll = (ll + 1) % len(baselayers)
+      trlayer = baselayers[trll]
+      trpix = firstpix if trll == 0 else getpixels(trlayer)
+      writer.append(bgpix, longtime/2 if (ll == 0 and midstart) else longtime)
+      for w in weights:
+        writer.append(blendpixels(bgpix, trpix, bglayer.has_alpha, trlayer.has_alpha, w), frdelay)
+      bgpix = trpix
+      gimp.progress_update(float(ll+1)/len(baselayers))
+
+    if (midstart):
+      writer.append(firstpix, longtime/2)
+  finally:
+    writer.close()
+
+#function making the switch animation, with 'nsteps' intermediate frames of the given 'easing' between two source layers
+def makeswitch(image, savepath, frdelay, longtime, rescale, midstart, nsteps=9, easing=0, apng=False):
   if (len(image.layers) < 2):
     errmess = "The SwitchImages animation need at least two source layers!"
     pdb.gimp_message(errmess)
@@ -52,7 +142,21 @@ def python_make_switchgif(image, tdrawable, savepath, frdelay, longtime, rescale
       if (ly.width != wd or ly.height != he):
         pdb.gimp_layer_scale(ly, wd, he, False)
   
-  intersteps = range(1, 10)
+  weights = easingweights(nsteps, easing)
+
+  #writing the animation directly to file if requested
+  if (apng):
+    if (len(savepath) == 0):
+      savepath = os.getcwd() + defsavename[:-4] + ".png"
+    elif (savepath[-4:] == ".gif"):
+      savepath = savepath[:-4] + ".png"
+    elif (savepath[-4:] != ".png"):
+      savepath = savepath + ".png"
+    streamswitch(baselayers, savepath, frdelay, longtime, midstart, weights)
+    return
+
+  abspos = 0
+  pixcache = {} #pixels of the source layers, by index in baselayers
   
   #Selecting the two contiguous layers between which the dissolvence is made
   for ll in range(len(baselayers)):
@@ -62,16 +166,36 @@ def python_make_switchgif(image, tdrawable, savepath, frdelay, longtime, rescale
     except IndexError:
       trlayer = baselayers[0]
       
-    #creating the phase of dissolvence between layers, setting a set of opacity and merging the paired layers
-    for i in intersteps:
-      abspos = ll * (len(intersteps)+1) + i
-      bglayertt = bglayer.copy()
-      trlayertt = trlayer.copy()
-      pdb.gimp_layer_set_opacity(trlayertt, i*10)
-      image.add_layer(trlayertt, abspos)
-      image.add_layer(bglayertt, abspos+1)
-      merglayer = pdb.gimp_image_merge_down(image, trlayertt, 0)
-      merglayer.name = "ph" + str(ll) + "phase" + str(i*10)
+    #creating the phase of dissolvence between layers
+    if np is not None and sameregion(bglayer, trlayer):
+      #reading each source layer once, blending the pixels and writing each new frame once
+      if ll not in pixcache:
+        pixcache[ll] = getpixels(bglayer)
+      trll = (ll + 1) % len(baselayers)
+      if trll not in pixcache:
+        pixcache[trll] = getpixels(trlayer)
+      bgpix = pixcache[ll]
+      trpix = pixcache[trll]
+      for w in weights:
+        abspos += 1
+        merglayer = pdb.gimp_layer_new(image, bglayer.width, bglayer.height, bglayer.type, stepname(ll, w), 100, LAYER_MODE_NORMAL)
+        image.add_layer(merglayer, abspos)
+        merglayer.set_offsets(*bglayer.offsets)
+        setpixels(merglayer, blendpixels(bgpix, trpix, bglayer.has_alpha, trlayer.has_alpha, w))
+      if ll > 0:
+        del pixcache[ll] #keeping only the first layer, needed again by the last dissolvence
+    else:
+      #setting a set of opacity and merging the paired layers
+      for w in weights:
+        abspos += 1
+        bglayertt = bglayer.copy()
+        trlayertt = trlayer.copy()
+        pdb.gimp_layer_set_opacity(trlayertt, w*100)
+        image.add_layer(trlayertt, abspos)
+        image.add_layer(bglayertt, abspos+1)
+        merglayer = pdb.gimp_image_merge_down(image, trlayertt, 0)
+        merglayer.name = stepname(ll, w)
+    abspos += 1
     
     #adjusting names for timing frame
     if (ll == 0 and midstart):
@@ -90,12 +214,19 @@ def python_make_switchgif(image, tdrawable, savepath, frdelay, longtime, rescale
   
   #preparing exporting to gif
   if (len(savepath) == 0):
-    savepath = os.getcwd() + defname
+    savepath = os.getcwd() + defsavename
   elif (savepath[-4:] != ".gif"):
     savepath = savepath + ".gif"
 
-  pdb.gimp_image_convert_indexed(image, 1, 0, 256, False, False, "ignored") # 1 in second argument: use dithering
-  pdb.file_gif_save(image, tdrawable, savepath, savepath, 0, 1, frdelay, 0)
+  exportgif(image, savepath, frdelay, GIFCOLORS, True) #True: use dithering
+
+#The function to be registered in GIMP
+def python_make_switchgif(image, tdrawable, savepath, frdelay, longtime, rescale, midstart):
+  makeswitch(image, savepath, frdelay, longtime, rescale, midstart)
+
+#The function to be registered in GIMP, with the number of steps, the easing and the animated png output
+def python_make_switchgif_steps(image, tdrawable, savepath, frdelay, longtime, rescale, midstart, nsteps, easing, apng):
+  makeswitch(image, savepath, frdelay, longtime, rescale, midstart, nsteps, easing, apng)
 
 
 #The command to register the function
@@ -120,5 +251,31 @@ In the gif, images follow the layer order (top to bottom of the layer list).",
   python_make_switchgif
   )
 
+#The command to register the function with the number of steps, the easing and the animated png output
+register(
+  "python-fu_make_switchgif_steps",
+  "python-fu_make_switchgif_steps",
+  "Create an animated gif or png which switches between two or more images with a dissolvence between them,\n\
+choosing the number of intermediate frames and the easing of the dissolvence.\n\
+In the animation, images follow the layer order (top to bottom of the layer list).",
+  "Valentino Esposito",
+  "Valentino Esposito",
+  "2018",
+  "<Image>/Filters/Animation/SwitchImages with steps",
+  "RGB*, GRAY*",
+  [
+    (PF_FILE, "savepath", "Destination", os.getcwd() + defsavename),
+    (PF_INT32, "frdelay", "Base delay between frames (ms)", 100),
+    (PF_INT32, "longtime", "Longer delay for basic frames (ms)", 2000),
+    (PF_BOOL, "rescale", "Does images have to be rescaled to the image size?", True),
+    (PF_BOOL, "midstart", "Does animation have to start in the middle of a longer delay?", True),
+    (PF_INT32, "nsteps", "Number of intermediate frames of each dissolvence", 9),
+    (PF_OPTION, "easing", "Timing of the dissolvence", 0, EASINGS),
+    (PF_BOOL, "apng", "Write an animated png instead of creating the frame layers and the gif?", False),
+  ],
+  [],
+  python_make_switchgif_steps
+  )
+
 #The main function to activate the script
 main()
@@ -30,10 +30,186 @@ import sys
 import os
 import math
 import random
+import multiprocessing
 from gimpfu import *
 
-#The function to be registered in gimp
-def python_smudgeall(img, tdraw, smudgefreq):
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+TILESIZE = 256 #side of the tiles processed by the batched smudge, in pixels
+ADVSTEPS = 4 #number of advection steps of the batched smudge
+
+
+#generic function to read a region of a drawable in a numpy array of floats with shape (height, width, bpp)
+def getpixels(drawable, x, y, w, h):
+  rgn = drawable.get_pixel_rgn(x, y, w, h, False, False)
+  return np.frombuffer(rgn[x:x+w, y:y+h], dtype=np.uint8).reshape(h, w, drawable.bpp).astype(np.float32)
+
+#generic function to write a numpy array with shape (height, width, bpp) in a region of a drawable
+def setpixels(drawable, x, y, pix):
+  h, w = pix.shape[:2]
+  rgn = drawable.get_pixel_rgn(x, y, w, h, True, True)
+  rgn[x:x+w, y:y+h] = np.around(np.clip(pix, 0, 255)).astype(np.uint8).tostring()
+
+#generic function to sample with bilinear interpolation an array (height, width, channels) at the float coordinates sx, sy
+def sampleat(pix, sx, sy):
+  hh, ww = pix.shape[:2]
+  sx = np.clip(sx, 0, ww - 1)
+  sy = np.clip(sy, 0, hh - 1)
+  x0 = np.minimum(np.floor(sx).astype(int), ww - 2) if ww > 1 else np.zeros(sx.shape, int)
+  y0 = np.minimum(np.floor(sy).astype(int), hh - 2) if hh > 1 else np.zeros(sy.shape, int)
+  fx = (sx - x0)[:, :, np.newaxis]
+  fy = (sy - y0)[:, :, np.newaxis]
+  x1 = np.minimum(x0 + 1, ww - 1)
+  y1 = np.minimum(y0 + 1, hh - 1)
+  top = pix[y0, x0] * (1 - fx) + pix[y0, x1] * fx
+  bottom = pix[y1, x0] * (1 - fx) + pix[y1, x1] * fx
+  return top * (1 - fy) + bottom * fy
+
+
+#function smudging a block of pixels, used by the batched smudge
+def smudgetile(pix, mask, dirx, diry, brs, pressure):
+  '''Smudge the pixels pix (array with shape (height, width, bpp)), dragging the colors of each pixel for brs pixels
+  along the direction (dirx, diry) given for each pixel. The drag is performed as an advection in ADVSTEPS steps,
+  each blending the color found upstream with the current one according to the pressure (0 to 100).
+  mask (values from 0 to 1) limits the effect, like the selection.
+  '''
+  hh, ww = pix.shape[:2]
+  gx, gy = np.meshgrid(np.arange(ww, dtype=np.float64), np.arange(hh, dtype=np.float64))
+  step = float(brs) / ADVSTEPS
+  rate = (pressure / 100.0) * mask[:, :, np.newaxis]
+  res = pix
+  for i in range(ADVSTEPS):
+    upstream = sampleat(res, gx - dirx * step, gy - diry * step)
+    res = res * (1 - rate) + upstream * rate
+  return res
+
+
+#function to find which grid points are close enough to the selection to be smudged
+def selectedcells(img, xll, yll, reach):
+  '''Return a list of lists of booleans, one for each point of the grid xll (columns), yll (rows): True if the square of
+  half side reach around the point contains some selected pixel. The selection mask is read once, and summarized in
+  blocks as large as the grid step, telling if the block contains selected pixels.
+  '''
+  xa = max(xll[0] - reach, 0)
+  xb = min(xll[-1] + reach + 1, img.width)
+  ya = max(yll[0] - reach, 0)
+  yb = min(yll[-1] + reach + 1, img.height)
+  bls = max(xll[1] - xll[0] if len(xll) > 1 else reach, 1) #block size
+  selection = pdb.gimp_image_get_selection(img)
+  rgn = selection.get_pixel_rgn(xa, ya, xb - xa, yb - ya, False, False)
+  data = rgn[xa:xb, ya:yb]
+  ww = xb - xa
+
+  nbx = (ww + bls - 1) / bls
+  nby = (yb - ya + bls - 1) / bls
+  blocks = [[False] * nbx for j in range(nby)]
+  for y in range(yb - ya):
+    row = data[y*ww:(y+1)*ww]
+    if row.strip("\x00") == "":
+      continue
+    brow = blocks[y / bls]
+    for bx in range(nbx):
+      if not brow[bx] and row[bx*bls:(bx+1)*bls].strip("\x00") != "":
+        brow[bx] = True
+
+  res = []
+  for cy in yll:
+    bya = max(cy - reach - ya, 0) / bls
+    byb = min(cy + reach - ya, yb - ya - 1) / bls
+    resrow = []
+    for cx in xll:
+      bxa = max(cx - reach - xa, 0) / bls
+      bxb = min(cx + reach - xa, ww - 1) / bls
+      resrow.append(any([any(blocks[by][bxa:bxb+1]) for by in range(bya, byb+1)]))
+    res.append(resrow)
+  return res
+
+
+#data shared with the worker processes of the batched smudge: they are forked after it is set, so it is not copied
+_tiledata = {}
+
+#function processing a single tile of the batched smudge, it can run in a worker process
+def smudgetilejob(tile):
+  '''Smudge the tile (tx, ty, tw, th), coordinates relative to the region stored in _tiledata, using the pixels of
+  the region around the tile padded by a bit more than the brush size. Return the tile and its smudged pixels.
+  '''
+  tx, ty, tw, th = tile
+  pix = _tiledata["pix"]
+  brs = _tiledata["brs"]
+  pad = brs + 2 #the advection reaches brs pixels, plus the bilinear interpolation
+  rh, rw = pix.shape[:2]
+  px = max(tx - pad, 0)
+  py = max(ty - pad, 0)
+  pe = min(tx + tw + pad, rw)
+  qe = min(ty + th + pad, rh)
+  win = (slice(py, qe), slice(px, pe))
+  res = smudgetile(pix[win], _tiledata["mask"][win], _tiledata["dirx"][win], _tiledata["diry"][win], brs, _tiledata["pressure"])
+  return tile, res[ty-py:ty-py+th, tx-px:tx-px+tw]
+
+
+#batched smudge, working on the pixels of tiles of the layer instead of calling the smudge tool
+def batchedsmudge(img, tdraw, smudgefreq, brs, xll, yll, rng, workers=1):
+  '''Smudge the layer with one random direction for each point of the grid xll, yll, like python_smudgeall does,
+  but moving the pixels locally. Each pixel takes the direction of the closest grid point. The pixels are read once,
+  then processed in tiles padded by the brush size, so that each tile gives the same result it would give as part of
+  the whole image and no blending of the overlaps is needed. Tiles outside the selection are skipped. With more than
+  one worker, tiles are processed in a pool of processes (only where processes can be forked). The result is written
+  once. The result depends only on the random generator rng, not on the tiles or the workers.
+  '''
+  angles = rng.uniform(0, 2 * math.pi, (len(yll), len(xll))).astype(np.float32)
+  gstep = max(brs/2, 1)
+  offx, offy = tdraw.offsets
+
+  xa = max(xll[0] - brs, 0)
+  xb = min(xll[-1] + brs, tdraw.width)
+  ya = max(yll[0] - brs, 0)
+  yb = min(yll[-1] + brs, tdraw.height)
+  pix = getpixels(tdraw, xa, ya, xb - xa, yb - ya)
+  if pdb.gimp_selection_is_empty(img):
+    mask = np.ones((yb - ya, xb - xa), dtype=np.float32)
+  else:
+    mask = getpixels(pdb.gimp_image_get_selection(img), xa + offx, ya + offy, xb - xa, yb - ya)[:, :, 0] / 255.0
+
+  cix = np.clip(np.around((np.arange(xa, xb) - xll[0]) / float(gstep)).astype(int), 0, len(xll) - 1)
+  ciy = np.clip(np.around((np.arange(ya, yb) - yll[0]) / float(gstep)).astype(int), 0, len(yll) - 1)
+  tang = angles[ciy[:, np.newaxis], cix[np.newaxis, :]]
+
+  #the same convention of the smudge tool stroke: x moves with the sine, y with the cosine
+  _tiledata.update({"pix": pix, "mask": mask, "dirx": np.sin(tang), "diry": np.cos(tang), "brs": brs, "pressure": smudgefreq})
+  tiles = [(tx, ty, min(TILESIZE, xb - xa - tx), min(TILESIZE, yb - ya - ty)) for ty in range(0, yb - ya, TILESIZE) for tx in range(0, xb - xa, TILESIZE)]
+  tiles = [tt for tt in tiles if mask[tt[1]:tt[1]+tt[3], tt[0]:tt[0]+tt[2]].any()]
+
+  if workers < 1:
+    workers = multiprocessing.cpu_count()
+  pool = None
+  if workers > 1 and len(tiles) > 1 and os.name == "posix":
+    pool = multiprocessing.Pool(min(workers, len(tiles)))
+    results = pool.imap_unordered(smudgetilejob, tiles)
+  else:
+    results = (smudgetilejob(tt) for tt in tiles)
+
+  out = pix.copy()
+  try:
+    for (tile, res), i in zip(results, range(len(tiles))):
+      tx, ty, tw, th = tile
+      out[ty:ty+th, tx:tx+tw] = res
+      gimp.progress_update(float(i+1)/len(tiles))
+  finally:
+    if pool is not None:
+      pool.terminate()
+    _tiledata.clear()
+
+  setpixels(tdraw, xa, ya, out)
+  tdraw.flush()
+  tdraw.merge_shadow(True)
+  tdraw.update(xa, ya, xb - xa, yb - ya)
+
+
+#function smudging the layer or the selection on a grid of points, get the number of points smudged
+def smudgeall(img, tdraw, smudgefreq, batched=False, seed=-1, workers=0):
   pdb.gimp_image_undo_group_start(img)
   
   brs = int(pdb.gimp_context_get_brush_size())
@@ -49,19 +225,52 @@ def python_smudgeall(img, tdraw, smudgefreq):
     xll = [x for x in range(brs/4, img.width-(brs/4), brs/2)]
     yll = [y for y in range(brs/4, img.height-(brs/4), brs/2)]
 
-  #apply smudge to all the coordinates
-  gimp.progress_update(0.0)
-  for cx, i in zip(xll, range(len(xll))):
-    for cy in yll:
-      rang = 2 * math.pi * random.random()
-      rsin = math.sin(rang) * brs
-      rcos = math.cos(rang) * brs
-      pdb.gimp_smudge(tdraw, smudgefreq, 4, [cx, cy, cx+rsin, cy+rcos])
-    
-    #Updating percentage bar
-    gimp.progress_update(float(i)/len(xll))
+  #with a selection, dropping the grid points whose smudge would not touch any selected pixel
+  if non_empty and len(xll) > 0 and len(yll) > 0:
+    keep = selectedcells(img, xll, yll, brs + (brs/2))
+  else:
+    keep = [[True] * len(xll) for cy in yll]
+  nsmudges = sum([sum(row) for row in keep])
+
+  #a negative seed gives a different result at each run
+  if seed < 0:
+    seed = random.randint(0, 2**31 - 1)
+
+  if batched and np is not None and nsmudges > 0:
+    gimp.progress_update(0.0)
+    batchedsmudge(img, tdraw, smudgefreq, brs, xll, yll, np.random.RandomState(seed), workers)
+  else:
+    if batched and np is None:
+      pdb.gimp_message("The batched smudge needs the numpy module, the smudge tool will be used.")
+
+    #apply smudge to all the coordinates
+    rgen = random.Random(seed)
+    gimp.progress_update(0.0)
+    for cx, i in zip(xll, range(len(xll))):
+      for cy, j in zip(yll, range(len(yll))):
+        rang = 2 * math.pi * rgen.random()
+        if not keep[j][i]:
+          continue
+        rsin = math.sin(rang) * brs
+        rcos = math.cos(rang) * brs
+        pdb.gimp_smudge(tdraw, smudgefreq, 4, [cx, cy, cx+rsin, cy+rcos])
 
+      #Updating percentage bar
+      gimp.progress_update(float(i)/len(xll))
+
+  pdb.gimp_progress_set_text("python-fu-smudgeall: " + str(nsmudges) + " of " + str(len(xll) * len(yll)) + " points smudged")
   pdb.gimp_image_undo_group_end(img)
+  return nsmudges
+
+
+#The function to be registered in gimp
+def python_smudgeall(img, tdraw, smudgefreq):
+  smudgeall(img, tdraw, smudgefreq)
+
+
+#The function to be registered in gimp, with the batched mode and the seed
+def python_smudgeall_seeded(img, tdraw, smudgefreq, batched, seed, workers):
+  return smudgeall(img, tdraw, smudgefreq, batched, seed, workers)
 
 
 #The command to register the function
@@ -81,5 +290,27 @@ register(
   python_smudgeall
   )
 
+#The command to register the function with the batched mode and the seed
+register(
+  "python-fu-smudgeall-seeded",
+  "python-fu-smudgeall-seeded",
+  "Smudge image in randomatic direction, with a seed and an optional batched smudge",
+  "Valentino Esposito",
+  "Valentino Esposito",
+  "2018",
+  "<Image>/Filters/SmudgeAll seeded",
+  "RGB*, GRAY*",
+  [
+    (PF_INT32, "smudgefreq", "Smudge pressure (0 <= pressure <= 100)", 50),
+    (PF_BOOL, "batched", "Smudge the pixels in the script (faster on big images, needs numpy)?", False),
+    (PF_INT32, "seed", "Seed of the random directions (negative for a random seed)", -1),
+    (PF_INT32, "workers", "Processes used by the batched smudge (0 for one per processor)", 0),
+  ],
+  [
+    (PF_INT32, "nsmudges", "The number of grid points smudged"),
+  ],
+  python_smudgeall_seeded
+  )
+
 #The main function to activate the script
 main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  snow_simulation.py
+#
+#  Copyright 2018 Valentino Esposito <valentinoe85@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+#This module holds the snow simulation of make_animation_snowing.py, it is not a plug-in and does not need GIMP,
+#so a simulation can be run, saved and tested outside GIMP.
+#It must be placed in ~/.gimp-n.m/plug-ins together with make_animation_snowing.py, without the executable permission
+#where n.m is the gimp version (e.g. 2.8)
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+#class holding all the flakes, as arrays of coordinates, radii and velocities
+class SnowField:
+  '''Class holding the state of all the flakes in numpy arrays (x, y, r, vx, vy), one element for each flake.
+  Flakes are moved all together by vectorized operations. The random transverse velocities are drawn again each frame
+  from the generator 'rng', so the velocities of a flake in different frames are independent.
+  '''
+  #constructor
+  def __init__(self, nflakes, radius, width, height, rng=None):
+    self.rng = rng if rng is not None else np.random.RandomState()
+    self.width = width
+    self.height = height
+    self.x = self.rng.uniform(1, width, nflakes)
+    self.y = self.rng.uniform(1, height, nflakes)
+    self.r = radius * (1 + (0.5 * self.rng.random_sample(nflakes)))
+    self.vx = np.zeros(nflakes)
+    self.vy = np.zeros(nflakes)
+
+  def __len__(self):
+    return len(self.x)
+
+  #method, get list of tuples (r, x, y), one for each flake
+  def get_flakes(self):
+    return list(zip(self.r.tolist(), self.x.tolist(), self.y.tolist()))
+
+  #method, apply velocities to the flakes: 'direc' is the direction (0 down, 1 right, 2 top, 3 left), 'pxspeed' the speed along it
+  #and 'maxobs' the max transverse speed. Flakes going outside the image reappear on the opposite side
+  def move(self, direc, pxspeed, maxobs):
+    n = len(self.x)
+    along = 1 if direc in [0, 2] else 0 #the axis of the motion: 0 for x, 1 for y
+    sign = 1 if direc in [0, 1] else -1
+    pos = [self.x, self.y]
+    vel = [self.vx, self.vy]
+    limits = [self.width, self.height]
+
+    #set velocity
+    vel[along][:] = sign * pxspeed
+    vel[1-along][:] = self.rng.uniform(-maxobs, maxobs, n)
+
+    #apply velocity
+    self.x += self.vx
+    self.y += self.vy
+
+    #correct flake position if it goes outside image boundaries
+    if sign > 0:
+      out = pos[along] > limits[along]
+    else:
+      out = pos[along] < 0
+    nout = np.count_nonzero(out)
+    if nout > 0:
+      pos[along][out] = 0 if sign > 0 else limits[along]
+      pos[1-along][out] = self.rng.uniform(1, limits[1-along], nout)
+
+  #method, move the flakes 'nframes' times and get the coordinates before each move, as two arrays (nframes, flakes)
+  def simulate(self, nframes, direc, pxspeed, maxobs):
+    xs = np.empty((nframes, len(self)), dtype=np.float32)
+    ys = np.empty((nframes, len(self)), dtype=np.float32)
+    for i in range(nframes):
+      xs[i] = self.x
+      ys[i] = self.y
+      self.move(direc, pxspeed, maxobs)
+    return xs, ys
+
+
+#function to run a seeded snow simulation without GIMP, get the flake radii and the flake coordinates of each frame
+def simulatesnow(seed, nflakes, radius, width, height, nframes, direc, pxspeed, maxobs):
+  rng = np.random.RandomState(seed if seed >= 0 else None)
+  flakes = SnowField(nflakes, radius, width, height, rng)
+  xs, ys = flakes.simulate(nframes, direc, pxspeed, maxobs)
+  return flakes.r, xs, ys
+
+#function to save the flake states of a simulation in a numpy .npz file
+def savestates(filename, r, xs, ys):
+  np.savez(filename, r=r, xs=xs, ys=ys)
+
+#function to load the flake states saved by savestates, from frame 'first' on (all of them if 'nframes' is None)
+def loadstates(filename, first=0, nframes=None):
+  data = np.load(filename)
+  last = None if nframes is None else first + nframes
+  return data["r"], data["xs"][first:last], data["ys"][first:last]
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  stroke_raster.py
+#  
+#  Copyright 2018 Valentino Esposito <valentinoe85@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+#This module holds the classes used by stroke_vectors_options.py to measure the strokes, compute the dash patterns and
+#rasterize the strokes locally. It is not a plug-in and does not need GIMP, so it can be used and tested outside GIMP.
+#It must be placed in ~/.gimp-n.m/plug-ins together with stroke_vectors_options.py, without the executable permission
+#where n.m is the gimp version (e.g. 2.8)
+
+import math
+import bisect
+import struct
+import zlib
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  STRTYPES = basestring
+except NameError: #python 3
+  STRTYPES = str
+
+TILESIZE = 256 #size of the tiles of the coverage buffer of StrokeRasterizer
+
+
+class StrokeSampler:
+  """Class to get points at given distances along a stroke of a vector, without querying GIMP for each point.
+  The control points of the stroke (as given by gimp_vectors_stroke_get_points) are read once and each cubic Bézier
+  segment is flattened in a polyline, with sides not longer than 'maxstep' pixels. Points are then found by bisection
+  on the cumulative lengths of the polyline.
+  """
+  #constructor
+  def __init__(self, controlpoints, closed, maxstep=1.0):
+    cps = list(controlpoints)
+    anchors = [(cps[i], cps[i+1], cps[i+2], cps[i+3], cps[i+4], cps[i+5]) for i in range(0, len(cps) - 5, 6)]
+    if closed and len(anchors) > 0:
+      anchors.append(anchors[0])
+
+    self.xs = []
+    self.ys = []
+    self.cumlen = []
+    if len(anchors) > 0:
+      self.xs.append(anchors[0][2])
+      self.ys.append(anchors[0][3])
+      self.cumlen.append(0.0)
+
+    for pca, pcb in zip(anchors[:-1], anchors[1:]):
+      x0, y0, x1, y1 = pca[2], pca[3], pca[4], pca[5]
+      x2, y2, x3, y3 = pcb[0], pcb[1], pcb[2], pcb[3]
+      hull = math.hypot(x1 - x0, y1 - y0) + math.hypot(x2 - x1, y2 - y1) + math.hypot(x3 - x2, y3 - y2)
+      nsteps = max(1, int(math.ceil(hull / maxstep)))
+      for k in range(1, nsteps+1):
+        t = float(k) / nsteps
+        mt = 1.0 - t
+        x = mt*mt*mt*x0 + 3*mt*mt*t*x1 + 3*mt*t*t*x2 + t*t*t*x3
+        y = mt*mt*mt*y0 + 3*mt*mt*t*y1 + 3*mt*t*t*y2 + t*t*t*y3
+        self.cumlen.append(self.cumlen[-1] + math.hypot(x - self.xs[-1], y - self.ys[-1]))
+        self.xs.append(x)
+        self.ys.append(y)
+
+    self.length = self.cumlen[-1] if len(self.cumlen) > 0 else 0.0
+
+  def pointat(self, dist):
+    """Get the (x, y) coordinates of the point at distance 'dist' from the start of the stroke"""
+    if len(self.cumlen) == 0:
+      raise ValueError("Error! The stroke has no anchors, there are no points to get")
+    if len(self.cumlen) < 2:
+      return (self.xs[0], self.ys[0])
+    k = min(max(bisect.bisect_right(self.cumlen, dist) - 1, 0), len(self.cumlen) - 2)
+    dl = self.cumlen[k+1] - self.cumlen[k]
+    frac = min(max((dist - self.cumlen[k]) / dl, 0.0), 1.0) if dl > 0 else 0.0
+    return (self.xs[k] + frac * (self.xs[k+1] - self.xs[k]), self.ys[k] + frac * (self.ys[k+1] - self.ys[k]))
+
+  def pointsat(self, distlist):
+    """Get the list of the (x, y) coordinates of the points at the distances in 'distlist'"""
+    return [self.pointat(dd) for dd in distlist]
+
+
+class DashPattern:
+  """Class holding a dash pattern, defined by a dash array as the stroke-dasharray of SVG: a list of lengths
+  alternating drawn (on) and undrawn (off) parts, repeated along the stroke. A list with an odd number of elements
+  is repeated twice. An 'on' length equal to 0 (or written as '.') is a dot marker.
+  The phase is the distance along the pattern at which the stroke starts.
+  """
+  #constructor
+  def __init__(self, dasharray, phase=0.0):
+    if isinstance(dasharray, STRTYPES):
+      dasharray = dasharray.replace(",", " ").split()
+    errmess = "dash array must be a non empty list of non negative lengths (or '.' for dots), with a positive sum"
+    try:
+      lens = [0.0 if e == "." else float(e) for e in dasharray]
+    except ValueError:
+      raise ValueError(errmess)
+    if len(lens) == 0 or any([l < 0 for l in lens]) or sum(lens) <= 0:
+      raise ValueError(errmess)
+    if len(lens) % 2 == 1:
+      lens = lens * 2
+
+    self.dasharray = lens
+    self.period = sum(lens)
+    self.phase = phase % self.period
+
+  def compile(self, length, scale=1.0, phase=None):
+    """Compute the parts of the pattern on a stroke of length 'length'. Pattern lengths are multiplied by 'scale'.
+    'phase' overrides the phase of the pattern. Return the list of the (start, stop) intervals of the dashes,
+    the list of the positions of the dots, both measured on the stroke, and the phase at the end of the stroke,
+    which can be used as phase of the following stroke to keep the pattern continuous.
+    """
+    if scale <= 0:
+      raise ValueError("the scale of the dash pattern must be positive")
+    if phase is None:
+      phase = self.phase
+    phase = phase % self.period
+    dashes = []
+    dots = []
+    pos = 0.0 - (phase * scale)
+    while pos < length:
+      for i, l in enumerate(self.dasharray):
+        seg = l * scale
+        if i % 2 == 0:
+          if seg == 0:
+            if pos >= 0 and pos < length:
+              dots.append(pos)
+          else:
+            sta = max(pos, 0.0)
+            end = min(pos + seg, length)
+            if end > sta:
+              dashes.append((sta, end))
+        pos = pos + seg
+
+    endphase = (phase + (float(length) / scale)) % self.period
+    return dashes, dots, endphase
+
+
+class StrokeRasterizer:
+  """Class to rasterize strokes locally, without the GIMP paint core. Polylines and dots are drawn as the
+  '2. Hardness 100' brush would do, with anti-aliased borders, in a coverage buffer (floats between 0 and 1) of size
+  'width' x 'height'. 'xoff' and 'yoff' are the coordinates of the top left pixel of the buffer.
+  The buffer is made of square tiles of TILESIZE pixels, allocated only when something is drawn on them, so the memory
+  used depends on the area covered by the strokes, not on the size of the image.
+  The buffer is then passed to an output sink (LayerSink or PNGSink) which writes it tile by tile.
+  """
+  #constructor
+  def __init__(self, width, height, xoff=0, yoff=0):
+    if np is None:
+      raise RuntimeError("Error! numpy module is needed for the local rasterization of the strokes.")
+    self.width = width
+    self.height = height
+    self.xoff = xoff
+    self.yoff = yoff
+    self.tiles = {} #coverage arrays by (column, row) index of the tile
+
+  def _window(self, xa, ya, xb, yb, rad):
+    """Return the slices of the buffer around the box (xa, ya) - (xb, yb) enlarged by 'rad', and the coordinates of the
+    centers of its pixels, or None if the box is outside the buffer.
+    """
+    xs = max(int(math.floor(min(xa, xb) - rad)) - self.xoff, 0)
+    xe = min(int(math.ceil(max(xa, xb) + rad)) - self.xoff + 1, self.width)
+    ys = max(int(math.floor(min(ya, yb) - rad)) - self.yoff, 0)
+    ye = min(int(math.ceil(max(ya, yb) + rad)) - self.yoff + 1, self.height)
+    if xs >= xe or ys >= ye:
+      return None
+    px = (np.arange(xs, xe, dtype=np.float32) + self.xoff + 0.5)[np.newaxis, :]
+    py = (np.arange(ys, ye, dtype=np.float32) + self.yoff + 0.5)[:, np.newaxis]
+    return (slice(ys, ye), slice(xs, xe)), px, py
+
+  def _tile(self, tx, ty):
+    """Get the coverage array of the tile of index (tx, ty), allocating it if needed"""
+    if (tx, ty) not in self.tiles:
+      tw = min(TILESIZE, self.width - tx * TILESIZE)
+      th = min(TILESIZE, self.height - ty * TILESIZE)
+      self.tiles[(tx, ty)] = np.zeros((th, tw), dtype=np.float32)
+    return self.tiles[(tx, ty)]
+
+  def _stamp(self, win, dist, rad):
+    """Merge in the buffer the coverage of the pixels at distance 'dist' from a shape of half width 'rad'"""
+    cov = np.clip(rad + 0.5 - dist, 0.0, 1.0)
+    ys, ye = win[0].start, win[0].stop
+    xs, xe = win[1].start, win[1].stop
+    for ty in range(ys // TILESIZE, (ye - 1) // TILESIZE + 1):
+      for tx in range(xs // TILESIZE, (xe - 1) // TILESIZE + 1):
+        #intersection of the window with the tile, in buffer coordinates
+        ia, ib = max(ys, ty * TILESIZE), min(ye, (ty + 1) * TILESIZE)
+        ja, jb = max(xs, tx * TILESIZE), min(xe, (tx + 1) * TILESIZE)
+        part = cov[ia-ys:ib-ys, ja-xs:jb-xs]
+        if not part.any():
+          continue
+        tile = self._tile(tx, ty)[ia-ty*TILESIZE:ib-ty*TILESIZE, ja-tx*TILESIZE:jb-tx*TILESIZE]
+        np.maximum(tile, part, out=tile)
+
+  def drawdot(self, x, y, size):
+    """Draw a dot of diameter 'size' centered in (x, y)"""
+    rad = size / 2.0
+    res = self._window(x, y, x, y, rad + 1)
+    if res is not None:
+      win, px, py = res
+      self._stamp(win, np.sqrt((px - x)**2 + (py - y)**2), rad)
+
+  def drawpolyline(self, points, size):
+    """Draw a polyline of width 'size' with round caps and joins through the list of (x, y) 'points'"""
+    if len(points) == 1:
+      self.drawdot(points[0][0], points[0][1], size)
+    rad = size / 2.0
+    for (xa, ya), (xb, yb) in zip(points[:-1], points[1:]):
+      res = self._window(xa, ya, xb, yb, rad + 1)
+      if res is None:
+        continue
+      win, px, py = res
+      dx = xb - xa
+      dy = yb - ya
+      seglen2 = dx*dx + dy*dy
+      if seglen2 > 0:
+        t = np.clip(((px - xa) * dx + (py - ya) * dy) / seglen2, 0.0, 1.0)
+      else:
+        t = 0.0
+      self._stamp(win, np.sqrt((px - xa - t*dx)**2 + (py - ya - t*dy)**2), rad)
+
+  def drawntiles(self):
+    """Return the sorted list of the drawn tiles, as (x, y, coverage) with x, y the buffer coordinates of the tile corner"""
+    return [(tx * TILESIZE, ty * TILESIZE, self.tiles[(tx, ty)]) for ty, tx in sorted((ty, tx) for tx, ty in self.tiles)]
+
+  def getregion(self, x, y, w, h):
+    """Return the coverage of the region (x, y, w, h) of the buffer as a (h, w) array, zero where nothing is drawn"""
+    res = np.zeros((h, w), dtype=np.float32)
+    for tx, ty, cov in self.drawntiles():
+      th, tw = cov.shape
+      ia, ib = max(y, ty), min(y + h, ty + th)
+      ja, jb = max(x, tx), min(x + w, tx + tw)
+      if ia < ib and ja < jb:
+        res[ia-y:ib-y, ja-x:jb-x] = cov[ia-ty:ib-ty, ja-tx:jb-tx]
+    return res
+
+  def bounds(self):
+    """Return the box (x, y, width, height) of the buffer containing all the drawn pixels, or None if nothing is drawn"""
+    box = None
+    for tx, ty, cov in self.drawntiles():
+      rows = np.nonzero(cov.any(axis=1))[0]
+      if len(rows) == 0:
+        continue
+      cols = np.nonzero(cov.any(axis=0))[0]
+      xa, ya, xb, yb = tx + cols[0], ty + rows[0], tx + cols[-1] + 1, ty + rows[-1] + 1
+      if box is not None:
+        xa, ya, xb, yb = min(xa, box[0]), min(ya, box[1]), max(xb, box[2]), max(yb, box[3])
+      box = (xa, ya, xb, yb)
+    if box is None:
+      return None
+    return int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1])
+
+
+class PNGSink:
+  """Output sink of StrokeRasterizer, writing the coverage buffer as the alpha channel of an RGBA png file
+  filled with a color. It does not need GIMP, so it can be used to check the rasterization.
+  The image is compressed one band of tiles at a time, without building the whole image in memory.
+  """
+  #constructor
+  def __init__(self, filename):
+    self.filename = filename
+
+  def commit(self, rasterizer, color):
+    """Write the coverage of 'rasterizer' with the (r, g, b) 'color' (values from 0 to 255) in the png file"""
+    hh, ww = rasterizer.height, rasterizer.width
+
+    def chunk(ctype, data):
+      return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data) & 0xffffffff)
+
+    comp = zlib.compressobj(6)
+    idat = []
+    for y in range(0, hh, TILESIZE):
+      bh = min(TILESIZE, hh - y)
+      pix = np.empty((bh, ww, 4), dtype=np.uint8)
+      pix[:, :, :3] = np.array(color[:3], dtype=np.uint8)
+      pix[:, :, 3] = np.around(rasterizer.getregion(0, y, ww, bh) * 255.0).astype(np.uint8)
+      rows = np.concatenate([np.zeros((bh, 1), dtype=np.uint8), pix.reshape(bh, ww * 4)], axis=1) #filter type 0 on each row
+      idat.append(comp.compress(rows.tobytes()))
+    idat.append(comp.flush())
+
+    with open(self.filename, "wb") as fpng:
+      fpng.write(b"\x89PNG\r\n\x1a\n")
+      fpng.write(chunk(b"IHDR", struct.pack(">IIBBBBB", ww, hh, 8, 6, 0, 0, 0)))
+      fpng.write(chunk(b"IDAT", b"".join(idat)))
+      fpng.write(chunk(b"IEND", b""))
@@ -30,12 +30,91 @@
 import sys
 import os
 from gimpfu import *
+from stroke_raster import StrokeSampler, DashPattern, StrokeRasterizer, PNGSink
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+class LayerSink:
+  """Output sink of StrokeRasterizer, painting the coverage buffer with a color on a GIMP drawable,
+  one drawn tile of the buffer at a time. As for the paint tools, only the selected pixels are painted,
+  the coverage being multiplied by the selection mask.
+  """
+  #constructor
+  def __init__(self, drawable):
+    self.drawable = drawable
+    self.selection = None
+
+  def commit(self, rasterizer, color):
+    """Paint on the drawable the coverage of 'rasterizer' with the (r, g, b) 'color' (values from 0 to 255)"""
+    if self.drawable.bpp - int(self.drawable.has_alpha) == 1:
+      col = np.array([0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]], dtype=np.float32)
+    else:
+      col = np.array(color[:3], dtype=np.float32)
+
+    img = self.drawable.image
+    self.selection = None if pdb.gimp_selection_is_empty(img) else pdb.gimp_image_get_selection(img)
+
+    for tx, ty, tcov in rasterizer.drawntiles():
+      #clipping the tile to the drawable, x and y are in drawable coordinates
+      th, tw = tcov.shape
+      x = max(tx + rasterizer.xoff - self.drawable.offsets[0], 0)
+      y = max(ty + rasterizer.yoff - self.drawable.offsets[1], 0)
+      bw = min(tx + tw + rasterizer.xoff - self.drawable.offsets[0], self.drawable.width) - x
+      bh = min(ty + th + rasterizer.yoff - self.drawable.offsets[1], self.drawable.height) - y
+      if bw <= 0 or bh <= 0:
+        continue
+      bx = x + self.drawable.offsets[0] - rasterizer.xoff - tx
+      by = y + self.drawable.offsets[1] - rasterizer.yoff - ty
+      cov = tcov[by:by+bh, bx:bx+bw]
+      if self.selection is not None:
+        cov = cov * self.selectionmask(x, y, bw, bh)
+      if cov.any():
+        self.paintregion(x, y, cov[:, :, np.newaxis], col)
+
+  def selectionmask(self, x, y, bw, bh):
+    """Get the selection mask (values from 0 to 1) of the region (x, y, bw, bh) of the drawable, 0 outside the image"""
+    res = np.zeros((bh, bw), dtype=np.float32)
+    #the region in image coordinates, clipped to the image
+    offx, offy = self.drawable.offsets
+    ixa, iya = max(x + offx, 0), max(y + offy, 0)
+    ixb, iyb = min(x + offx + bw, self.selection.width), min(y + offy + bh, self.selection.height)
+    if ixa < ixb and iya < iyb:
+      rgn = self.selection.get_pixel_rgn(ixa, iya, ixb - ixa, iyb - iya, False, False)
+      sel = np.frombuffer(rgn[ixa:ixb, iya:iyb], dtype=np.uint8).reshape(iyb - iya, ixb - ixa)
+      res[iya-y-offy:iyb-y-offy, ixa-x-offx:ixb-x-offx] = sel / 255.0
+    return res
+
+  def paintregion(self, x, y, cov, col):
+    """Paint the coverage 'cov' (array of shape (h, w, 1)) with the color 'col' at (x, y) of the drawable"""
+    bh, bw = cov.shape[:2]
+    bpp = self.drawable.bpp
+    nch = bpp - 1 if self.drawable.has_alpha else bpp
+
+    srcrgn = self.drawable.get_pixel_rgn(x, y, bw, bh, False, False)
+    pix = np.frombuffer(srcrgn[x:x+bw, y:y+bh], dtype=np.uint8).reshape(bh, bw, bpp).astype(np.float32)
+    if self.drawable.has_alpha:
+      dsta = pix[:, :, nch:] / 255.0
+      outa = cov + dsta * (1.0 - cov)
+      outc = (col * cov + pix[:, :, :nch] * dsta * (1.0 - cov)) / np.where(outa > 0, outa, 1.0)
+      pix = np.concatenate([outc, outa * 255.0], axis=2)
+    else:
+      pix = col * cov + pix * (1.0 - cov)
+
+    dstrgn = self.drawable.get_pixel_rgn(x, y, bw, bh, True, True)
+    dstrgn[x:x+bw, y:y+bh] = np.around(pix).astype(np.uint8).tostring()
+    self.drawable.flush()
+    self.drawable.merge_shadow(True)
+    self.drawable.update(x, y, bw, bh)
 
 
 class VectorStroker:
   """Class to stroke a vector"""
   #constructor
-  def __init__(self, image, tdraw, vector, pixsize, tstroke):
+  def __init__(self, image, tdraw, vector, pixsize, tstroke, dasharray=None, phase=0.0, continuous=False, sink=None):
     self.img = image
     self.layer = tdraw
     self.vector = vector
@@ -46,9 +125,33 @@ class VectorStroker:
     self.factorlistb = [0.6, 0.5]
     self.ndotsperunilist = [2, 3, 5, 10]
     self.dotspace = 0.2
+    self.minspacing = 0.01 #the min and max brush spacing allowed by GIMP, as a fraction of the brush size
+    self.maxspacing = 50.0
+
+    #the dash pattern: a custom dash array (lengths in units of pixsize) or the preset of tstroke
+    if dasharray is not None:
+      self.pattern = DashPattern(dasharray, phase)
+    elif self.tstroke > 0:
+      self.pattern = DashPattern(self.presetpattern(self.tstroke), phase)
+    else:
+      self.pattern = None
+    if self.pattern is not None and pixsize <= 0:
+      errmess = "The size of a dashed or dotted stroke must be positive!"
+      pdb.gimp_message(errmess)
+      raise ValueError(errmess)
+    self.continuous = continuous
+
+    #if an output sink is given, the strokes are rasterized locally and passed to it instead of using the GIMP paint core
+    self.sink = sink
+    self.rasterizer = None
+
+    self.strokecache = {} #StrokeSampler objects (length and geometry) for each stroke id, emptied at each stroking
+    self.cachehits = 0
+    self.cachemisses = 0
 
     self.oldbrush = pdb.gimp_context_get_brush()
     self.oldbrushsize = pdb.gimp_context_get_brush_size()
+    self.oldbrushspacing = pdb.gimp_context_get_brush_spacing()
 
   def checkvector(self):
     """Checking the presence of a vector"""
@@ -57,41 +160,104 @@ class VectorStroker:
       res = False
     return res
 
-  def drawdash(self, sid, start, stop, fd):
-    """Draw a single dash segment on the vector path with id 'sid' starting from 'start' and terminating at 'stop'
-    'start' and 'stop' are measured on the path, and only the first 'fd' part is actually drawn.
+  def clearcache(self):
+    """Empty the cache of the strokes and reset its counters"""
+    self.strokecache = {}
+    self.cachehits = 0
+    self.cachemisses = 0
+
+  def getstroke(self, sid):
+    """Get the StrokeSampler object of the stroke with id 'sid'. The control points of the stroke are read from GIMP
+    only the first time, then the object is taken from the cache. Hits and misses of the cache are counted.
     """
+    if sid in self.strokecache:
+      self.cachehits = self.cachehits + 1
+    else:
+      self.cachemisses = self.cachemisses + 1
+      _, _, controlpoints, closed = pdb.gimp_vectors_stroke_get_points(self.vector, sid)
+      self.strokecache[sid] = StrokeSampler(controlpoints, closed)
+    return self.strokecache[sid]
 
-    if stop > start:
-      ltodraw = (stop - start) * fd
-      steps = (2*ltodraw) / self.pxs
-      dp = [start + ((i * ltodraw)/steps) for i in range(int(steps)+1)]
+  def cachestats(self):
+    """Return the number of hits and misses of the cache of the strokes, useful for profiling"""
+    return self.cachehits, self.cachemisses
 
-      length = pdb.gimp_vectors_stroke_get_length(self.vector, sid, 0.1)
-      points = [pdb.gimp_vectors_stroke_get_point_at_dist(self.vector, sid, dd, 0.1)[0:2] for dd in dp if dd < length]
-      strokes = list(sum(points, ())) #this flatten the list of tuples
-      
-      pdb.gimp_paintbrush_default(self.layer, len(strokes), strokes)
+  def presetpattern(self, tstroke):
+    """Return the dash array (lengths in units of pixsize) reproducing the prebuilt line type 'tstroke' (1 to 9)"""
+    unit = self.dashl / float(self.pxs)
+    if tstroke in [1, 2, 3]: #long, medium, short dashed line
+      factor = self.factorlist[tstroke-1]
+      return [factor * unit, (1 - factor) * unit]
+    elif tstroke in [4, 5, 6, 7]: #sparse, normal, dense dotted, stippled line
+      return [0, unit / self.ndotsperunilist[tstroke-4]]
+    elif tstroke in [8, 9]: #dash dotted, dash dot dotted line
+      factor = self.factorlistb[tstroke-8]
+      ndots = tstroke - 7
+      dotgap = ((1 - factor - self.dotspace) * unit) / ndots
+      return [factor * unit, self.dotspace * unit] + [0, dotgap] * ndots
     else:
-      pdb.gimp_message("Error! drawdash 'stop' argument is lesser than 'start' argument!")
+      raise ValueError("Error! Preset patterns are defined only for line types from 1 to 9")
 
-  def drawdotted(self, sid, start, stop, np):
-    """Draw equally spaced 'np' dots on the vector path with id 'sid' starting from 'start' and terminating at 'stop'
-    'start' and 'stop' are measured on the path, and the spacing considers that at the 'stop' point there is an extra undrawn dot
+  def drawpattern(self, sid, dashes, dots):
+    """Draw the dashes and the dots computed by DashPattern.compile on the vector path with id 'sid'.
+    The points of all the dashes are sampled at once, then each dash is painted with a single call.
     """
+    sampler = self.getstroke(sid)
+    if self.rasterizer is not None:
+      for sta, end in dashes:
+        steps = max(int((2*(end - sta)) / self.pxs), 1)
+        self.rasterizer.drawpolyline(sampler.pointsat([sta + ((i * (end - sta)) / steps) for i in range(steps+1)]), self.pxs)
+      for x, y in sampler.pointsat(dots):
+        self.rasterizer.drawdot(x, y, self.pxs)
+      return
 
-    if stop > start:
-      ltodraw = (stop - start)
-      dp = [start + ((i * ltodraw)/(np)) for i in range(int(np))]
+    runs = []
+    for sta, end in dashes:
+      steps = max(int((2*(end - sta)) / self.pxs), 1)
+      runs.append([sta + ((i * (end - sta)) / steps) for i in range(steps+1)])
+    points = sampler.pointsat([dd for run in runs for dd in run])
 
-      length = pdb.gimp_vectors_stroke_get_length(self.vector, sid, 0.1)
-      points = [pdb.gimp_vectors_stroke_get_point_at_dist(self.vector, sid, dd, 0.1)[0:2] for dd in dp if dd < length]
+    k = 0
+    for run in runs:
+      strokes = list(sum(points[k:k+len(run)], ())) #this flatten the list of tuples
+      pdb.gimp_paintbrush_default(self.layer, len(strokes), strokes)
+      k = k + len(run)
 
-      for strokes in points:
-        pdb.gimp_paintbrush_default(self.layer, 2, strokes)
+    self.drawdots(sid, dots)
 
-    else:
-      pdb.gimp_message("Error! drawdotted 'stop' argument is lesser than 'start' argument!")
+  def drawdots(self, sid, dots):
+    """Draw dots at the positions 'dots' (measured on the path and in increasing order) on the vector path with id 'sid'.
+    Consecutive dots with the same spacing are painted with a single brush stroke following the path, with the brush
+    spacing set to the dot spacing, so that the brush leaves one dab for each dot. Dots whose spacing is outside the
+    range of the brush spacing accepted by GIMP are painted one by one.
+    """
+    sampler = self.getstroke(sid)
+
+    #grouping the dots in runs of equally spaced dots
+    runs = []
+    for dd in dots:
+      if len(runs) > 0 and len(runs[-1]) > 1 and abs((dd - runs[-1][-1]) - (runs[-1][1] - runs[-1][0])) < 1e-6 * self.pxs:
+        runs[-1].append(dd)
+      elif len(runs) > 0 and len(runs[-1]) == 1 and self.minspacing <= (dd - runs[-1][0]) / self.pxs <= self.maxspacing:
+        runs[-1].append(dd)
+      else:
+        runs.append([dd])
+
+    for run in runs:
+      if len(run) == 1:
+        pdb.gimp_paintbrush_default(self.layer, 2, sampler.pointat(run[0]))
+        continue
+
+      gap = run[1] - run[0]
+      #the brush path runs a bit beyond the last dot, so that rounding does not lose its dab
+      end = min(run[-1] + 0.25 * gap, sampler.length)
+      steps = max(int((2*(end - run[0])) / self.pxs), 1)
+      dp = [run[0] + ((i * (end - run[0])) / steps) for i in range(steps+1)]
+      strokes = list(sum(sampler.pointsat(dp), ())) #this flatten the list of tuples
+
+      pdb.gimp_context_set_brush_spacing(gap / self.pxs)
+      pdb.gimp_paintbrush_default(self.layer, len(strokes), strokes)
+      pdb.gimp_context_set_brush_spacing(self.oldbrushspacing)
 
   def stroking(self):
     """Stroking the vector path according to the parameters in the object attributes"""
@@ -99,50 +265,46 @@ class VectorStroker:
       pdb.gimp_message("You have to create and select a path!")
       return None
       
+    #the buffer of the local rasterization, before opening the undo group since it fails without numpy
+    if self.sink is not None:
+      self.rasterizer = StrokeRasterizer(self.img.width, self.img.height)
+
     pdb.gimp_image_undo_group_start(self.img)
 
     #setting the brush
     pdb.gimp_context_set_brush('2. Hardness 100')
     pdb.gimp_context_set_brush_size(self.pxs)
 
-    #checking the vector
+    #checking the vector, each stroke will be read and measured only once in this run
     _, stroke_ids = pdb.gimp_vectors_get_strokes(self.vector)
+    self.clearcache()
 
     #drawing
-    if self.tstroke == 0: #solid line
-      pdb.gimp_edit_stroke_vectors(self.layer, self.vector)
-    elif self.tstroke in [1, 2, 3]: #long, medium, short dashed line
-      factor = self.factorlist[self.tstroke-1]
+    #strokes with less than two anchors have nothing to draw
+    stroke_ids = [ids for ids in stroke_ids if self.getstroke(ids).length > 0]
+
+    if self.pattern is None and self.rasterizer is not None: #solid line
       for ids in stroke_ids:
-        length = pdb.gimp_vectors_stroke_get_length(self.vector, ids, 0.1)
-        ndash = length/self.dashl
-        for i in range(int(ndash)+1):
-          self.drawdash(ids, i * self.dashl, (i+1) * self.dashl, factor)
-        
-    elif self.tstroke in [4, 5, 6, 7]: #sparse, normal, dense dotted, stippled line
-      ndotsperuni = self.ndotsperunilist[self.tstroke-4]
+        self.drawpattern(ids, [(0.0, self.getstroke(ids).length)], [])
+    elif self.pattern is None:
+      pdb.gimp_edit_stroke_vectors(self.layer, self.vector)
+    else:
+      phase = self.pattern.phase
       for ids in stroke_ids:
-        length = pdb.gimp_vectors_stroke_get_length(self.vector, ids, 0.1)
-        ns = (ndotsperuni * length) / self.dashl
-        self.drawdotted(ids, 0, length, ns+1)
+        length = self.getstroke(ids).length
+        dashes, dots, endphase = self.pattern.compile(length, self.pxs, phase)
+        self.drawpattern(ids, dashes, dots)
+        if self.continuous:
+          phase = endphase
 
-    elif self.tstroke in [8, 9]: #dash dotted, dash dot dotted line
-      factor = self.factorlistb[self.tstroke-8]
-      for ids in stroke_ids:
-        length = pdb.gimp_vectors_stroke_get_length(self.vector, ids, 0.1)
-        ndash = length/self.dashl
-        for i in range(int(ndash)+1):
-          sta = i * self.dashl
-          end = (i+1) * self.dashl
-          stb = (i + factor + self.dotspace) * self.dashl
-          self.drawdash(ids, sta, end, factor)
-          if self.tstroke == 8:
-            self.drawdotted(ids, stb, end, 1)
-          if self.tstroke == 9:
-            self.drawdotted(ids, stb, end, 2)
+    if self.rasterizer is not None:
+      fgcol = pdb.gimp_context_get_foreground()
+      self.sink.commit(self.rasterizer, (int(fgcol.r * 255), int(fgcol.g * 255), int(fgcol.b * 255)))
+      self.rasterizer = None
 
     pdb.gimp_context_set_brush(self.oldbrush)
     pdb.gimp_context_set_brush_size(self.oldbrushsize)
+    pdb.gimp_context_set_brush_spacing(self.oldbrushspacing)
     pdb.gimp_image_undo_group_end(self.img)
 
 
@@ -152,6 +314,16 @@ def python_strokevectors(img, tdraw, vector, pixsize, tstroke):
   vs.stroking()
 
 
+#The function to be registered in gimp
+def python_strokevectors_dasharray(img, tdraw, vector, pixsize, dasharray, phase, continuous, localraster):
+  if localraster and np is None:
+    pdb.gimp_message("The local rasterization needs the numpy module, the GIMP paint core will be used.")
+    localraster = False
+  sink = LayerSink(tdraw) if localraster else None
+  vs = VectorStroker(img, tdraw, vector, pixsize, 1, dasharray, phase, continuous, sink)
+  vs.stroking()
+
+
 #The command to register the function
 register(
   "python-fu-stroke-vectors",
@@ -173,5 +345,28 @@ Normal dotted (5); Dense dotted (6); Stipples (7); Dash dotted (8); Dash dot dot
   python_strokevectors
   )
 
+register(
+  "python-fu-stroke-vectors-dasharray",
+  "python-fu-stroke-vectors-dasharray",
+  "Stroke a path with a custom dash pattern, given as a dash array like the SVG stroke-dasharray. \
+This script is intended to be used mainly by other scripts which need to repplicate those features.",
+  "Valentino Esposito",
+  "Valentino Esposito",
+  "2018",
+  "<Image>/Edit/StrokeVectorDashArray",
+  "RGB*, GRAY*",
+  [
+    (PF_VECTORS, "vector", "The path to be stroked", None),
+    (PF_INT32, "pixsize", "Size in pixel of the stroke", 5),
+    (PF_STRING, "dasharray", "Lengths, in units of the stroke size, alternating drawn and undrawn parts.\n \
+A drawn length of 0 (or .) is a dot. E.g. dash dotted: 6 2 0 2", "7 3"),
+    (PF_FLOAT, "phase", "Distance along the pattern at which the stroking starts", 0.0),
+    (PF_BOOL, "continuous", "Does the pattern continue across the strokes of the path?", False),
+    (PF_BOOL, "localraster", "Rasterize the strokes in the script (needs numpy) instead of using the GIMP paint core?", False),
+  ],
+  [ ],
+  python_strokevectors_dasharray
+  )
+
 #The main function to activate the script
 main()
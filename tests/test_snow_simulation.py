@@ -0,0 +1,45 @@
+#tests of snow_simulation.py, they do not need GIMP: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from snow_simulation import SnowField, simulatesnow, savestates, loadstates
+
+#seed, flakes, radius, width, height, frames, direction (down), speed, max transverse speed
+SIMARGS = (1234, 500, 3.0, 200, 150, 30, 0, 5, 3)
+
+
+def test_seed_gives_identical_states():
+  r, xs, ys = simulatesnow(*SIMARGS)
+  r2, xs2, ys2 = simulatesnow(*SIMARGS)
+  assert xs.shape == ys.shape == (30, 500)
+  assert (r == r2).all() and (xs == xs2).all() and (ys == ys2).all()
+
+  r3, xs3, ys3 = simulatesnow(SIMARGS[0] + 1, *SIMARGS[1:])
+  assert not (xs == xs3).all()
+
+
+def test_transverse_velocities_change_each_frame():
+  flakes = SnowField(1000, 3.0, 10000, 10000, np.random.RandomState(7))
+  flakes.move(0, 5, 3)
+  vxa = flakes.vx.copy()
+  flakes.move(0, 5, 3)
+  assert (flakes.vy == 5).all()
+  assert np.abs(vxa).max() <= 3
+  assert abs(np.corrcoef(vxa, flakes.vx)[0, 1]) < 0.2
+  assert abs(np.corrcoef(vxa[1:], flakes.vx[:-1])[0, 1]) < 0.2
+
+
+def test_states_round_trip(tmpdir):
+  r, xs, ys = simulatesnow(*SIMARGS)
+  filename = str(tmpdir.join("states.npz"))
+  savestates(filename, r, xs, ys)
+
+  r2, xs2, ys2 = loadstates(filename)
+  assert (r == r2).all() and (xs == xs2).all() and (ys == ys2).all()
+
+  r3, xs3, ys3 = loadstates(filename, 10, 5)
+  assert (r == r3).all() and (xs[10:15] == xs3).all() and (ys[10:15] == ys3).all()
@@ -0,0 +1,83 @@
+#tests of stroke_raster.py, they do not need GIMP: python -m pytest tests
+
+import os
+import sys
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from stroke_raster import StrokeSampler, DashPattern, StrokeRasterizer, PNGSink, TILESIZE
+
+
+#read the RGBA pixels of a png written by PNGSink (8 bit, no interlace, filter type 0 on each row)
+def readpng(filename):
+  with open(filename, "rb") as fpng:
+    data = fpng.read()
+  assert data[:8] == b"\x89PNG\r\n\x1a\n"
+  pos = 8
+  idat = b""
+  while pos < len(data):
+    length, = struct.unpack(">I", data[pos:pos+4])
+    ctype = data[pos+4:pos+8]
+    body = data[pos+8:pos+8+length]
+    if ctype == b"IHDR":
+      width, height, depth, colortype = struct.unpack(">IIBB", body[:10])
+      assert (depth, colortype) == (8, 6)
+    elif ctype == b"IDAT":
+      idat += body
+    pos += length + 12
+  rows = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width * 4 + 1)
+  assert (rows[:, 0] == 0).all()
+  return rows[:, 1:].reshape(height, width, 4)
+
+
+#control points of a straight stroke from (xa, y) to (xb, y), as given by gimp_vectors_stroke_get_points
+def straightstroke(xa, xb, y):
+  return [xa, y, xa, y, xa, y, xb, y, xb, y, xb, y]
+
+
+def test_dashed_stroke_png(tmpdir):
+  width, height = 300, 40
+  sampler = StrokeSampler(straightstroke(10.0, 290.0, 20.0), False)
+  assert abs(sampler.length - 280.0) < 1e-6
+  dashes, dots, endphase = DashPattern("20 10").compile(sampler.length)
+  assert dashes[:3] == [(0.0, 20.0), (30.0, 50.0), (60.0, 80.0)]
+
+  rasterizer = StrokeRasterizer(width, height)
+  for sta, end in dashes:
+    rasterizer.drawpolyline(sampler.pointsat([sta, end]), 6.0)
+  filename = str(tmpdir.join("dashes.png"))
+  PNGSink(filename).commit(rasterizer, (255, 0, 0))
+
+  pix = readpng(filename)
+  assert pix.shape == (height, width, 4)
+  assert (pix[:, :, 0] == 255).all()
+  alpha = pix[20, :, 3]
+  for sta, end in dashes:
+    if end - sta >= 20.0:
+      assert alpha[int(10 + (sta + end) / 2)] == 255 #dash centers are covered
+  for sta, end in zip([d[1] for d in dashes[:-1]], [d[0] for d in dashes[1:]]):
+    assert alpha[int(10 + (sta + end) / 2)] == 0 #gap centers are empty
+  assert (pix[:10, :, 3] == 0).all() and (pix[30:, :, 3] == 0).all()
+  assert rasterizer.bounds() == (7, 17, 286, 6)
+
+
+def test_rasterizer_allocates_drawn_tiles_only():
+  rasterizer = StrokeRasterizer(10000, 10000)
+  rasterizer.drawpolyline([(100.5, 100.5), (600.5, 100.5)], 4.0)
+  assert len(rasterizer.tiles) == 3
+  assert all(tile.shape == (TILESIZE, TILESIZE) for tile in rasterizer.tiles.values())
+  assert rasterizer.bounds() == (98, 98, 505, 5)
+  region = rasterizer.getregion(90, 90, 530, 20)
+  assert region[10, 10:510].min() == 1.0
+  assert region.sum() == sum(cov.sum() for tx, ty, cov in rasterizer.drawntiles())
+
+
+def test_dash_pattern_rejects_non_positive_scale():
+  pattern = DashPattern("7 3")
+  for scale in [0, -1.0]:
+    with pytest.raises(ValueError):
+      pattern.compile(100.0, scale)
@@ -26,8 +26,22 @@
 
 import sys
 import math
+import bisect
+import array
 from gimpfu import *
 
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+#nodes and weights of the 5 points Gauss-Legendre quadrature on the [-1, 1] interval
+GLNODES = [-0.9061798459386640, -0.5384693101056831, 0.0, 0.5384693101056831, 0.9061798459386640]
+GLWEIGHTS = [0.2369268850561891, 0.4786286704993665, 0.5688888888888889, 0.4786286704993665, 0.2369268850561891]
+LENMETHODS = ["gauss", "split"]
+GLMINDEPTH = 2 #min number of interval halvings of the adaptive Gauss-Legendre length
+GLSAFETY = 10.0 #the disagreement of the two estimates must be this factor below the tolerance
+
 class CompBezierCurve:
   '''Class holding the control points of a composite Bézier curve.
   Two CBCPoint objects are needed to draw a cubic Bézier curve between them. This curve is part of a composite Bézier curve,
@@ -229,20 +243,23 @@ class CompBezierCurve:
   def __init__(self, *bzp):
     errmess = "Input should be one or more CBCControlPoint objects or a list/tuple whose elements are numeric and its length is multiple of 6"
     if all([isinstance(i, self.CBCPoint) for i in bzp]):
-      self.cbc = bzp
+      self.cbc = list(bzp)
     elif len(bzp) % 3 == 0 and all([isinstance(i, self.Point) for i in bzp]):
-      np = len(bzp) / 3
+      npts = len(bzp) / 3
       self.cbc = []
-      for i in range(np):
+      for i in range(npts):
         self.cbc.append(self.CBCPoint(*bzp[3*i:3*(i+1)]))
     elif len(bzp) % 6 == 0 and all([isinstance(i, (int, long, float)) for i in bzp]):
-      np = len(bzp) / 6
+      npts = len(bzp) / 6
       self.cbc = []
-      for i in range(np):
+      for i in range(npts):
         self.cbc.append(self.CBCPoint(bzp[6*i:6*(i+1)]))
     else:
       raise RuntimeError(errmess)
     self.closed = False
+    self._lentable = None
+    self._coeffarr = None
+    self._bbox = {}
 
   def __repr__(self):
     restr = "{ "
@@ -266,12 +283,20 @@ class CompBezierCurve:
     '''overloading setitem operator'''
     if isinstance(item, self.CBCPoint):
       self.cbc[key] = item
+      self._invalidate()
     else:
       raise TypeError("Error! You must assign a CBCControlPoint object.")
 
   def __delitem__(self, key):
     '''overloading delitem operator'''
     del self.cbc[key]
+    self._invalidate()
+
+  def _invalidate(self):
+    '''Drop the cached values computed from the control points. Called each time the control points are changed'''
+    self._lentable = None
+    self._coeffarr = None
+    self._bbox = {}
 
   def lenseq(self):
     '''return the length of the sequence obtained with getfullseq() method'''
@@ -345,6 +370,96 @@ class CompBezierCurve:
 
     return res
     
+  def _coeffarrays(self):
+    '''Return a numpy array of shape (n, 4, 2) with the coefficients (as given by beziercoeff method) of the n Bézier
+    curves of the composite Bézier curve. The array is built once and kept until the control points are changed.
+    '''
+    if np is None:
+      raise RuntimeError("Error! numpy module is needed for the batch evaluation of the curve.")
+    if self._coeffarr is None:
+      cpa = np.array(self.getfullseq(), dtype=float).reshape(-1, 3, 2)
+      pzero = cpa[:-1, 1]
+      pone = cpa[:-1, 2]
+      ptwo = cpa[1:, 0]
+      pthree = cpa[1:, 1]
+      c = 3.0 * (pone - pzero)
+      b = 3.0 * (ptwo - pone) - c
+      a = pthree - pzero - c - b
+      self._coeffarr = np.stack([a, b, c, pzero], axis=1)
+    return self._coeffarr
+
+  def getpatarray(self, i, t):
+    '''Batch version of getpat method. i and t are sequences (or numpy arrays) of the same length with the indexes of
+    the Bézier curves (starting from 1) and the t parameters (0 <= t <= 1). Return two numpy arrays of shape (n, 2):
+    the coordinates of the points and the tangent vectors (first derivative with respect to t) at the points.
+    '''
+    coeff = self._coeffarrays()
+    i = np.asarray(i, dtype=int)
+    t = np.asarray(t, dtype=float)
+    if np.any(t < 0.0) or np.any(t > 1.0):
+      raise ValueError("t parameter must be between 0 and 1")
+    if np.any(i < 1) or np.any(i > self.numbezc()):
+      raise ValueError("i parameter out of range. In this spline there are only " + str(self.numbezc()) + " Bézier curves")
+
+    ca, cb, cc, cd = [coeff[i-1, k] for k in range(4)]
+    tt = t[:, np.newaxis]
+    points = ((ca * tt + cb) * tt + cc) * tt + cd
+    tangents = (3.0 * ca * tt + 2.0 * cb) * tt + cc
+    return points, tangents
+
+  def getdistpararray(self, d, nsamples=32):
+    '''Batch version of getdistpar method. d is a sequence (or numpy array) of distances from the beginning of the
+    composite Bézier curve. Return two numpy arrays with the indexes of the Bézier curves and the t parameters.
+    '''
+    cumlen = np.asarray(self.lentable(nsamples))
+    if len(cumlen) < 2:
+      raise RuntimeError("Error! Control points are not enough, there is no composite Bézier curve to measure!")
+    d = np.asarray(d, dtype=float)
+    if np.any(d < 0.0) or np.any(d > cumlen[-1]):
+      raise ValueError("length outside range: must be greater than 0 or lesser than the total length of the composite Bézier curve")
+
+    k = np.minimum(np.searchsorted(cumlen, d, side='right') - 1, len(cumlen) - 2)
+    dl = cumlen[k+1] - cumlen[k]
+    frac = np.where(dl > 0.0, (d - cumlen[k]) / np.where(dl > 0.0, dl, 1.0), 0.0)
+    return (k // nsamples) + 1, ((k % nsamples) + frac) / float(nsamples)
+
+  def getpointsarray(self, d, nsamples=32):
+    '''Get the coordinates of the points at distances d from the beginning of the composite Bézier curve and the tangent
+    vectors at the points, all in one call. d is a sequence (or numpy array) of distances. Return two numpy arrays of
+    shape (n, 2), as getpatarray method.
+    '''
+    i, t = self.getdistpararray(d, nsamples)
+    return self.getpatarray(i, t)
+
+  def getnormalsarray(self, i, t):
+    '''Batch version of getderat method. i and t are sequences (or numpy arrays) as in getpatarray method.
+    Return three numpy arrays of shape (n, 2): the coordinates of the points, the unit tangent vectors and the
+    unit normal vectors (the tangent vectors rotated by 90 degrees counterclockwise).
+    '''
+    points, tangents = self.getpatarray(i, t)
+    coeff = self._coeffarrays()
+    i = np.asarray(i, dtype=int)
+    tt = np.asarray(t, dtype=float)[:, np.newaxis]
+
+    #where the first derivative is null, its direction is the one of the first non null higher derivative
+    for higher in [6.0 * coeff[i-1, 0] * tt + 2.0 * coeff[i-1, 1], coeff[i-1, 0]]:
+      null = np.hypot(tangents[:, 0], tangents[:, 1]) == 0.0
+      if not np.any(null):
+        break
+      tangents[null] = higher[null]
+
+    norm = np.hypot(tangents[:, 0], tangents[:, 1])[:, np.newaxis]
+    tangents = tangents / np.where(norm > 0.0, norm, 1.0)
+    normals = np.stack([-tangents[:, 1], tangents[:, 0]], axis=1)
+    return points, tangents, normals
+
+  def getnormalsdarray(self, d, nsamples=32):
+    '''Batch version of getderad method: as getnormalsarray method, with the points given by a sequence (or numpy array)
+    of distances d from the beginning of the composite Bézier curve.
+    '''
+    i, t = self.getdistpararray(d, nsamples)
+    return self.getnormalsarray(i, t)
+
   def splitbezier(self, t, i, j=None):
     '''split from i-th to j-th Bézier curves of the composite Bézier curve each into two Bézier curves.
     Each curve is splitted at point t (0 <= t <= 1) using de Casteljau's algorithm.
@@ -392,11 +507,64 @@ class CompBezierCurve:
     perim = pzero.distp(pone) + pone.distp(ptwo) + ptwo.distp(pthree)
     return (perim + chord) / 2.0
 
-  def lencurve(self, i, t=1.0, precision=1, maxiter=10):
-    '''Calculate the approximated length of the i-th Bézier curve belonging to the composite Bézier curve
-    with a recursive numerical method up to precision. i starts from 1. Length is calculated from the
-    starting point up to t (0 <= t <= 1). The approximated method consists in splitting recursively the original
-    curve and using _lencurveappr method on all the splitted curves. maxiter is the number ofmax iteration
+  def _derivcoeff(self, i):
+    '''Return the coefficients of the first derivative of the i-th Bézier curve as a tuple: the first three
+    are the coefficients of t^2, t, 1 for the x coordinate, the last three for the y coordinate.
+    '''
+    cps = self.getbezc(i)
+    ca, cb, cc, _ = self.beziercoeff(cps[0], cps[1])
+    return (3.0 * ca['x'], 2.0 * cb['x'], cc['x'], 3.0 * ca['y'], 2.0 * cb['y'], cc['y'])
+
+  def _speedint(self, dc, ta, tb):
+    '''Integrate the speed |B'(t)| of a Bézier curve between ta and tb with the 5 points Gauss-Legendre quadrature.
+    dc is the tuple with the coefficients of the first derivative, as given by _derivcoeff method.
+    '''
+    half = (tb - ta) / 2.0
+    mid = (tb + ta) / 2.0
+    res = 0.0
+    for x, w in zip(GLNODES, GLWEIGHTS):
+      t = mid + half*x
+      dx = (dc[0] * t + dc[1]) * t + dc[2]
+      dy = (dc[3] * t + dc[4]) * t + dc[5]
+      res += w * math.sqrt(dx*dx + dy*dy)
+    return res * half
+
+  def _lencurvegauss(self, i, t, precision, maxiter):
+    '''Calculate the length of the i-th Bézier curve from the starting point up to t with an adaptive Gauss-Legendre
+    quadrature of the speed |B'(t)|. Each interval is halved at least GLMINDEPTH times, and then until the quadrature on
+    the whole interval and the sum on the two halves agree within its share of precision divided by GLSAFETY. The minimum
+    depth avoids accepting by chance an interval where the speed vanishes (a control point on its anchor), the safety
+    factor makes the disagreement a conservative estimate. The error is an estimate, not a guaranteed bound: intervals
+    reaching maxiter halvings are accepted anyway, so the returned error may be greater than precision and the caller can
+    check it. Return the length, the estimated error (the sum of the disagreements of the accepted intervals) and the
+    number of accepted intervals.
+    '''
+    dc = self._derivcoeff(i)
+
+    ll = 0.0
+    err = 0.0
+    cc = 0
+    stack = [(0.0, t, self._speedint(dc, 0.0, t), precision, 0)]
+    while len(stack) > 0:
+      ta, tb, whole, tol, depth = stack.pop()
+      tm = (ta + tb) / 2.0
+      left = self._speedint(dc, ta, tm)
+      right = self._speedint(dc, tm, tb)
+      ierr = abs(left + right - whole)
+      if (ierr * GLSAFETY <= tol and depth >= GLMINDEPTH) or depth >= maxiter:
+        ll += left + right
+        err += ierr
+        cc = cc+1
+      else:
+        stack.append((tm, tb, right, tol / 2.0, depth+1))
+        stack.append((ta, tm, left, tol / 2.0, depth+1))
+
+    return ll, err, cc
+
+  def _lencurvesplit(self, i, t, precision, maxiter):
+    '''Calculate the approximated length of the i-th Bézier curve from the starting point up to t by splitting
+    recursively the curve and using _lencurveappr method on all the splitted curves, until two iterations agree
+    within precision. maxiter is the max number of iterations.
     '''
     splitccbc = self.splitbezier(t, i)
     ccbc = CompBezierCurve(splitccbc[0], splitccbc[1])
@@ -421,82 +589,222 @@ class CompBezierCurve:
 
     return ll, err, cc
 
-  def lenfullcurve(self, precision=1, maxiter=10):
+  def lencurve(self, i, t=1.0, precision=1, maxiter=10, method="gauss"):
+    '''Calculate the length of the i-th Bézier curve belonging to the composite Bézier curve up to precision.
+    i starts from 1. Length is calculated from the starting point up to t (0 <= t <= 1).
+    method selects the numerical method: "gauss" (default) uses an adaptive Gauss-Legendre quadrature of the speed
+    of the curve, maxiter is the max number of interval halvings; "split" uses the recursive splitting of the curve,
+    maxiter is the max number of iterations. Return the length, the estimated error and the number of iterations.
+    When maxiter is reached, "gauss" returns its best estimate (check the returned error), "split" raises RuntimeError.
+    '''
+    if t < 0.0 or t > 1.0:
+      raise ValueError("t parameter must be between 0 and 1")
+    if t == 0.0:
+      return 0.0, 0.0, 0
+    if method == "gauss":
+      return self._lencurvegauss(i, t, precision, maxiter)
+    elif method == "split":
+      return self._lencurvesplit(i, t, precision, maxiter)
+    else:
+      raise ValueError("Error, method argument must be one of: " + ", ".join(LENMETHODS))
+
+  def lenfullcurve(self, precision=1, maxiter=10, method="gauss"):
     '''Calculate the approximated length of the composite Bézier curve using lencurve method'''
-    allenc = [self.lencurve(i, 1.0, precision, maxiter)[0] for i in range(1, self.numbezc()+1)]
+    allenc = [self.lencurve(i, 1.0, precision, maxiter, method)[0] for i in range(1, self.numbezc()+1)]
     integrlenc = [sum(allenc[:i+1]) for i in range(len(allenc))]
     if len(integrlenc) == 0:
       raise RuntimeError("Error! Control points are not enough, there is no composite Bézier curve to measure!")
     return integrlenc[-1]
 
-  def getpad(self, i, d, precision=1, maxiter=100):
-    '''Get the coordinate of the point at distance d (0 <= d <= lencurve) on the i--th Bézier curve
-    in the composite Bézier curve. i starts from 1, d is in coordinate units.
-    Due to non linearity of t (0 <= t <= 1) the distance is estimated through brute force calculation,
-    searching a t parameter close enough to the requested distance.
+  def _solvet(self, i, d, precision, maxiter, nsamples=32):
+    '''Get the t parameter of the point at distance d from the beginning of the i-th Bézier curve, with an error on
+    the distance not greater than precision. The arc-length table gives the two samples around d, and the
+    remaining length is found with Newton's method on the length function, whose derivative is the speed |B'(t)|.
+    Steps falling outside the current bracket, or at a null speed, are replaced by bisection steps.
     '''
-    lenc, _, _ = self.lencurve(i)
-    if d < 0.0 or d > lenc:
+    cumlen = self.lentable(nsamples)
+    base = cumlen[(i-1)*nsamples]
+    lenc = cumlen[i*nsamples] - base
+    if d < 0.0 or d > lenc + precision:
       raise ValueError("Length outside range: must be greater than 0 or lesser than the length of the Bézier curve " + str(lenc))
-
-    #using bisection method
-    searchpar = [0.0, 0.5, 1.0]
-    estt = None
+    if d >= lenc:
+      return 1.0
+    elif d <= 0.0:
+      return 0.0
+
+    k = min(bisect.bisect_right(cumlen, base + d, (i-1)*nsamples, i*nsamples) - 1, i*nsamples - 1)
+    ta = float(k - (i-1)*nsamples) / nsamples
+    tb = ta + 1.0 / nsamples
+    dsa = d - (cumlen[k] - base) #distance still to be covered from the ta sample
+    dl = cumlen[k+1] - cumlen[k]
+    t = ta + ((dsa / dl) / nsamples if dl > 0.0 else 0.0)
+
+    dc = self._derivcoeff(i)
+    lo = ta
+    hi = tb
     c = 0
     while c < maxiter:
-      lt = self.lencurve(i, searchpar[1])[0]
-      if d < lt - precision:
-        nspar = [searchpar[0], (searchpar[1] + searchpar[0])/2.0, searchpar[1]]
-      elif d > lt + precision:
-        nspar = [searchpar[1], (searchpar[2] + searchpar[1])/2.0, searchpar[2]]        
-      elif d <= lt + precision and d >= lt - precision:
-        estt = searchpar[1]
-        break
-      searchpar = nspar
+      f = self._speedint(dc, ta, t) - dsa
+      if abs(f) <= precision:
+        return t
+      if f > 0.0:
+        hi = t
+      else:
+        lo = t
+      dx = (dc[0] * t + dc[1]) * t + dc[2]
+      dy = (dc[3] * t + dc[4]) * t + dc[5]
+      speed = math.sqrt(dx*dx + dy*dy)
+      nt = t - (f / speed) if speed > 0.0 else lo
+      if nt <= lo or nt >= hi:
+        nt = (lo + hi) / 2.0
+      t = nt
       c = c+1
-      
-    if estt is None:
-      raise RuntimeError("Error, max number of iteration reached and a value within precision has not been found!")
-    else:
-      return self.getpat(i, estt)
+
+    raise RuntimeError("Error, max number of iteration reached and a value within precision has not been found!")
+
+  def getpad(self, i, d, precision=1, maxiter=100):
+    '''Get the coordinate of the point at distance d (0 <= d <= lencurve) on the i--th Bézier curve
+    in the composite Bézier curve. i starts from 1, d is in coordinate units.
+    Due to non linearity of t (0 <= t <= 1) the t parameter is searched with the _solvet method,
+    until the distance of the point is within precision from d.
+    '''
+    return self.getpat(i, self._solvet(i, d, precision, maxiter))
     
-  def getpointcbc(self, d, delta=5):
-    '''It calculates the coordinate of the point at distance d from the beginning of the composite Bézier curve
-    and the slope of the tangent at the point. Distance d and delta are measured on the composite Bézier curve
-    in the coordinate units. delta is the step used to calculate the slope (should be greater than the precision
-    used in lencurve method to have a reliable estimate of the slope. 
+  def getbbox(self, mode="curve"):
+    '''Return the bounding box of the composite Bézier curve as a tuple (xmin, ymin, xmax, ymax).
+    mode can be: "nodes", the box of the main points only; "hull", the box of all the control points, which always
+    contains the curve; "curve", the exact box of the curve, including the extrema where the derivative of each Bézier
+    curve is null. Each box is calculated once and kept until the control points are changed.
     '''
-    allenc = [self.lencurve(i)[0] for i in range(1, self.numbezc()+1)]
-    integrlenc = [sum(allenc[:i+1]) for i in range(len(allenc))]
-    if d > integrlenc[-1] or d < 0:
+    if mode in self._bbox:
+      return self._bbox[mode]
+
+    seq = self.getfullseq()
+    if len(seq) == 0:
+      raise RuntimeError("Error! There are no control points, the bounding box is not defined!")
+    if mode == "nodes":
+      xs = seq[2::6]
+      ys = seq[3::6]
+    elif mode == "hull":
+      xs = seq[0::2]
+      ys = seq[1::2]
+    elif mode == "curve":
+      xs = seq[2::6]
+      ys = seq[3::6]
+      for i in range(1, self.numbezc()+1):
+        cps = self.getbezc(i)
+        ca, cb, cc, cd = self.beziercoeff(cps[0], cps[1])
+        for l, ll in zip(['x', 'y'], [xs, ys]):
+          #roots in (0, 1) of the derivative 3a t^2 + 2b t + c
+          qa = 3.0 * ca[l]
+          qb = 2.0 * cb[l]
+          qc = cc[l]
+          if qa == 0.0:
+            roots = [-qc / qb] if qb != 0.0 else []
+          else:
+            disc = qb*qb - 4.0*qa*qc
+            if disc < 0.0:
+              roots = []
+            else:
+              sq = math.sqrt(disc)
+              roots = [(-qb + sq) / (2.0*qa), (-qb - sq) / (2.0*qa)]
+          for t in roots:
+            if 0.0 < t < 1.0:
+              ll.append(((ca[l] * t + cb[l]) * t + cc[l]) * t + cd[l])
+    else:
+      raise ValueError("Error, mode argument must be 'nodes', 'hull' or 'curve'")
+
+    self._bbox[mode] = (min(xs), min(ys), max(xs), max(ys))
+    return self._bbox[mode]
+
+  def lentable(self, nsamples=32):
+    '''Return the cumulative arc-length table of the composite Bézier curve. Each Bézier curve is sampled at nsamples+1
+    equally spaced t values and the lengths between the samples, calculated with the Gauss-Legendre quadrature, are
+    accumulated from the beginning of the composite curve, so the k-th element of the table is the distance of the sample
+    (k / nsamples + 1)-th curve, t = (k % nsamples) / nsamples. The table is built once and kept until the control
+    points are changed.
+    '''
+    if self._lentable is not None and self._lentable[0] == nsamples:
+      return self._lentable[1]
+
+    cumlen = [0.0]
+    for i in range(1, self.numbezc()+1):
+      dc = self._derivcoeff(i)
+      for k in range(nsamples):
+        cumlen.append(cumlen[-1] + self._speedint(dc, float(k) / nsamples, float(k+1) / nsamples))
+
+    self._lentable = (nsamples, cumlen)
+    return cumlen
+
+  def getdistpar(self, d, nsamples=32, precision=None, maxiter=20):
+    '''Get the index i (starting from 1) of the Bézier curve and the parameter t (0 <= t <= 1) of the point at distance d
+    from the beginning of the composite Bézier curve. The arc-length table given by lentable method is searched by
+    bisection and t is linearly interpolated between the two closest samples. If precision is given, t is then refined
+    with the _solvet method until the distance of the point is within precision from d.
+    '''
+    cumlen = self.lentable(nsamples)
+    if len(cumlen) < 2:
+      raise RuntimeError("Error! Control points are not enough, there is no composite Bézier curve to measure!")
+    if d < 0.0 or d > cumlen[-1]:
       raise ValueError("length outside range: must be greater than 0 or lesser than the total length of the composite Bézier curve")
-    else:        
-      shiftlenc = [0] + integrlenc[:-1]
-      refcurve = [(i+1, l, sil) for i, l, il, sil in zip(range(len(integrlenc)), allenc, integrlenc, shiftlenc) if d <= il and d >= sil][0]
-      dd = d - refcurve[2]
-      ptcoor = self.getpad(refcurve[0], dd)
 
-      #the derivative
-      try:
-        dpp = self.getpad(refcurve[0], dd+delta) - ptcoor
-        slp = dpp['y'] / dpp['x']
-      except ValueError:
-        slp = None
-        
-      try:
-        dpm = self.getpad(refcurve[0], dd-delta) - ptcoor
-        slm = dpm['y'] / dpm['x']
-      except ValueError:
-        slm = None
-        
-      if slp is None:
-        slope = slm
-      elif slm is None:
-        slope = slp
-      else:
-        slope = (slp + slm) / 2.0
+    k = min(bisect.bisect_right(cumlen, d) - 1, len(cumlen) - 2)
+    i = (k / nsamples) + 1
+    if precision is not None:
+      return i, self._solvet(i, d - cumlen[(i-1)*nsamples], precision, maxiter, nsamples)
+    dl = cumlen[k+1] - cumlen[k]
+    frac = (d - cumlen[k]) / dl if dl > 0.0 else 0.0
+    return i, ((k % nsamples) + frac) / float(nsamples)
+
+  def getderat(self, i, t):
+    '''Get the first derivative (with respect to t) of the i-th Bézier curve at t (0 <= t <= 1) and the unit normal
+    vector at the same point, obtained rotating the derivative by 90 degrees counterclockwise. Both are Point objects.
+    Where the first derivative is null (e.g. at an end point coinciding with its control point), the normal is
+    calculated from the first non null higher derivative.
+    '''
+    if t < 0.0 or t > 1.0:
+      raise ValueError("t parameter must be between 0 and 1")
+    cps = self.getbezc(i)
+    ca, cb, cc, _ = self.beziercoeff(cps[0], cps[1])
+
+    der = self.Point()
+    for l in ['x', 'y']:
+      der[l] = (3.0 * ca[l] * t + 2.0 * cb[l]) * t + cc[l]
+
+    direc = der
+    for higher in [(ca * (6.0 * t)) + (cb * 2.0), ca]:
+      if direc['x'] != 0.0 or direc['y'] != 0.0:
+        break
+      direc = higher
+
+    norm = math.hypot(direc['x'], direc['y'])
+    if norm == 0.0:
+      raise ValueError("Error! The Bézier curve is degenerated in a point, the normal is not defined")
+    normal = self.Point(-direc['y'] / norm, direc['x'] / norm)
+    return der, normal
+
+  def getderad(self, d, precision=0.01):
+    '''Get the coordinate of the point at distance d from the beginning of the composite Bézier curve, the first
+    derivative and the unit normal vector at the point, as given by getderat method. The point is placed within
+    precision from d.
+    '''
+    i, t = self.getdistpar(d, precision=precision)
+    der, normal = self.getderat(i, t)
+    return self.getpat(i, t), der, normal
+
+  def getpointcbc(self, d, precision=0.01):
+    '''It calculates the coordinate of the point at distance d from the beginning of the composite Bézier curve
+    and the slope of the tangent at the point. Distance d is measured on the composite Bézier curve in the
+    coordinate units. The slope is calculated from the first derivative of the curve, it is infinite for
+    vertical tangents.
+    '''
+    ptcoor, der, _ = self.getderad(d, precision)
+    if der['x'] == 0.0:
+      slope = float("inf") if der['y'] >= 0.0 else float("-inf")
+    else:
+      slope = der['y'] / der['x']
     return ptcoor, slope
-    
+
   def shift(self, x, y):
     '''Shift the full curve by (+x, +y)'''
     return CompBezierCurve(*[e.shift(x, y) for e in self.cbc])
@@ -508,6 +816,182 @@ class CompBezierCurve:
     return CompBezierCurve(*[e.scale(rx, ry) for e in self.cbc])
 
 
+class PackedCompBezierCurve(CompBezierCurve):
+  '''Composite Bézier curve keeping all the control points in a single flat array of doubles (x0, y0, x1, y1, etc.),
+  in the same order of getfullseq method, instead of a Point object for each control point.
+  It uses a fraction of the memory of CompBezierCurve and affine transforms can be applied in place (through a numpy
+  view of the array, when numpy is available). Indexing works as in CompBezierCurve: CBCPoint objects are built
+  from the array when requested and written back to it when assigned.
+  '''
+  #constructor
+  def __init__(self, *bzp):
+    errmess = "Input should be one array of doubles, one or more CBCControlPoint objects or a list/tuple whose elements are numeric and its length is multiple of 6"
+    if len(bzp) == 1 and isinstance(bzp[0], array.array) and bzp[0].typecode == 'd' and len(bzp[0]) % 6 == 0:
+      self.buf = bzp[0]
+    elif all([isinstance(i, self.CBCPoint) for i in bzp]):
+      self.buf = array.array('d', [c for e in bzp for c in e.getxyseq()])
+    elif len(bzp) % 6 == 0 and all([isinstance(i, (int, long, float)) for i in bzp]):
+      self.buf = array.array('d', bzp)
+    else:
+      raise RuntimeError(errmess)
+    self.closed = False
+    self._lentable = None
+    self._coeffarr = None
+    self._bbox = {}
+
+  def __repr__(self):
+    restr = "{ "
+    for i in range(len(self.buf) / 6):
+      restr += '[ ' + str(self[i]) + ' ] '
+    restr += "}"
+    return restr
+
+  def __str__(self):
+    return self.__repr__()
+
+  def _index(self, key):
+    '''Return the position in the array of the first coordinate of the key-th CBCPoint, supporting negative keys'''
+    n = len(self.buf) / 6
+    if key < 0:
+      key = key + n
+    if key < 0 or key >= n:
+      raise IndexError("CBCPoint index out of range")
+    return 6*key
+
+  def __getitem__(self, key):
+    '''overloading getitem operator'''
+    if isinstance(key, slice):
+      return [self[k] for k in range(*key.indices(len(self.buf) / 6))]
+    pos = self._index(key)
+    return self.CBCPoint(self.buf[pos:pos+6].tolist())
+
+  def __setitem__(self, key, item):
+    '''overloading setitem operator'''
+    if isinstance(item, self.CBCPoint):
+      pos = self._index(key)
+      self.buf[pos:pos+6] = array.array('d', item.getxyseq())
+      self._invalidate()
+    else:
+      raise TypeError("Error! You must assign a CBCControlPoint object.")
+
+  def __delitem__(self, key):
+    '''overloading delitem operator'''
+    pos = self._index(key)
+    del self.buf[pos:pos+6]
+    self._invalidate()
+
+  def lenseq(self):
+    '''return the length of the sequence obtained with getfullseq() method'''
+    return len(self.buf)
+
+  def numbezc(self):
+    '''return how many Bézier curves there are in the composite Bézier curve'''
+    return len(self.buf) / 6 - 1
+
+  def getfullseq(self):
+    '''return a single list with x0, y0, x1, y1, etc. containing all the points'''
+    return self.buf.tolist()
+
+  def _coeffarrays(self):
+    '''As the CompBezierCurve method, reading the control points from the array without copying them'''
+    if np is None:
+      raise RuntimeError("Error! numpy module is needed for the batch evaluation of the curve.")
+    if self._coeffarr is None:
+      cpa = np.frombuffer(self.buf, dtype=float).reshape(-1, 3, 2)
+      pzero = cpa[:-1, 1]
+      pone = cpa[:-1, 2]
+      ptwo = cpa[1:, 0]
+      pthree = cpa[1:, 1]
+      c = 3.0 * (pone - pzero)
+      b = 3.0 * (ptwo - pone) - c
+      a = pthree - pzero - c - b
+      self._coeffarr = np.stack([a, b, c, pzero], axis=1)
+    return self._coeffarr
+
+  def affine(self, xx, xy, yx, yy, x0=0.0, y0=0.0, inplace=False):
+    '''Apply the affine transform x' = xx*x + xy*y + x0, y' = yx*x + yy*y + y0 to all the control points.
+    If inplace is True the array of this curve is changed and the curve itself is returned,
+    otherwise a new PackedCompBezierCurve is returned.
+    '''
+    res = self if inplace else PackedCompBezierCurve(array.array('d', self.buf))
+    res.closed = self.closed
+    if np is not None:
+      cpa = np.frombuffer(res.buf, dtype=float).reshape(-1, 2)
+      xs = cpa[:, 0].copy()
+      cpa[:, 0] *= xx
+      cpa[:, 0] += xy * cpa[:, 1] + x0
+      cpa[:, 1] *= yy
+      cpa[:, 1] += yx * xs + y0
+    else:
+      buf = res.buf
+      for k in range(0, len(buf), 2):
+        x = buf[k]
+        y = buf[k+1]
+        buf[k] = xx * x + xy * y + x0
+        buf[k+1] = yx * x + yy * y + y0
+    res._invalidate()
+    return res
+
+  def shift(self, x, y):
+    '''Shift the full curve by (+x, +y)'''
+    return self.affine(1.0, 0.0, 0.0, 1.0, x, y)
+
+  def scale(self, rx, ry=None):
+    '''Scale the path by a ratio rx and ry, each dimension can be scaled independently'''
+    if ry is None:
+      ry = rx
+    return self.affine(rx, 0.0, 0.0, ry)
+
+
+#generic function used to bend a text stroke along a leading path
+def bendcurve(bzclead, cbc, vertex, halfheight, basexdis, lowering):
+  '''Bend the PackedCompBezierCurve cbc along the composite Bézier curve bzclead. Each main point is placed at
+  distance lowering * (x - vertex x) + basexdis along bzclead, and moved along the normal of bzclead by its height
+  above vertex minus halfheight. Its control points are rotated as the tangent of bzclead.
+  Return a new PackedCompBezierCurve.
+  '''
+  res = PackedCompBezierCurve(array.array('d', cbc.buf))
+  res.closed = cbc.closed
+  if np is not None:
+    cpa = np.frombuffer(res.buf, dtype=float).reshape(-1, 3, 2)
+    plc, tang, _ = bzclead.getnormalsdarray((lowering * (cpa[:, 1, 0] - vertex['x'])) + basexdis)
+
+    #angle of the tangent, taken in (-pi/2, pi/2] so that the text is never upside down
+    tanangle = np.arctan2(tang[:, 1], tang[:, 0])
+    tanangle = np.where(tanangle > math.pi/2.0, tanangle - math.pi, tanangle)
+    tanangle = np.where(tanangle <= -math.pi/2.0, tanangle + math.pi, tanangle)
+    cosa = np.cos(tanangle)[:, np.newaxis]
+    sina = np.sin(tanangle)[:, np.newaxis]
+
+    ydis = (vertex['y'] - cpa[:, 1, 1] - halfheight)[:, np.newaxis]
+    finp = plc + ydis * np.hstack([sina, -cosa]) #the direction at tanangle - pi/2
+    for k in [0, 2]:
+      vec = cpa[:, k] - cpa[:, 1]
+      cpa[:, k, 0] = finp[:, 0] + cosa[:, 0] * vec[:, 0] - sina[:, 0] * vec[:, 1]
+      cpa[:, k, 1] = finp[:, 1] + sina[:, 0] * vec[:, 0] + cosa[:, 0] * vec[:, 1]
+    cpa[:, 1] = finp
+    res._invalidate()
+    return res
+
+  for k in range(res.numbezc()+1):
+    cbcpp = res[k]
+    xdis = cbcpp.getctrlp(1)['x'] - vertex['x']
+    plc, der, _ = bzclead.getderad((lowering*xdis) + basexdis)
+
+    #angle of the tangent, taken in (-pi/2, pi/2] so that the text is never upside down
+    tanangle = math.atan2(der['y'], der['x'])
+    if tanangle > math.pi/2.0:
+      tanangle = tanangle - math.pi
+    elif tanangle <= -math.pi/2.0:
+      tanangle = tanangle + math.pi
+    angle = tanangle - math.pi/2.0
+    ydis = vertex['y'] - cbcpp.getctrlp(1)['y'] - halfheight
+    finp = plc.pointatdistm(angle, ydis)
+    shiftvec = finp - cbcpp.getctrlp(1)
+    res[k] = cbcpp.shift(shiftvec['x'], shiftvec['y']).rotate(tanangle)
+  return res
+
+
 #The function to be registered in GIMP
 def python_text_along_path(img, tdraw, text, txtsize, usedfont, leadpath):
   pdb.gimp_image_undo_group_start(img)
@@ -526,59 +1010,33 @@ def python_text_along_path(img, tdraw, text, txtsize, usedfont, leadpath):
   bzctext = []
   for sid in stroke_ids:
     _, _, controlpoints, isclosed = pdb.gimp_vectors_stroke_get_points(textvec, sid)
-    bzctext.append(CompBezierCurve(*controlpoints))
+    bzctext.append(PackedCompBezierCurve(*controlpoints))
     bzctext[-1].closed = isclosed
 
-  #recovering coordinates
-  allx = []
-  ally = []
-  for cc in bzctext:
-    allx.extend([e.getxy('x')[1] for e in cc.cbc])
-    ally.extend([e.getxy('y')[1] for e in cc.cbc])
-
-  #scaling the text to the length of the leading path if the leading path is shorted
-  xlen = max(allx) - min(allx)
-  bzcleadlen = bzclead.lenfullcurve()
-  scalefac = (bzcleadlen / xlen) if (bzcleadlen / xlen) < 1.0 else 1.0 
-  scaledbzctext = [i.scale(scalefac) for i in bzctext]
-
-  #shifting the text to the position of the leading path
-  vertex = CompBezierCurve.Point(min(allx)*scalefac, max(ally)*scalefac)
-  shiftpoint = bzclead[0].getctrlp(1) - vertex
-  shiftedbzctext = [i.shift(shiftpoint['x'], shiftpoint['y']) for i in scaledbzctext]
-
-  #recovering coordinates of shifted and scaled text
-  ssallx = []
-  ssally = []
-  for cc in shiftedbzctext:
-    ssallx.extend([e.getxy('x')[1] for e in cc.cbc])
-    ssally.extend([e.getxy('y')[1] for e in cc.cbc])
-  shvertex = CompBezierCurve.Point(min(ssallx), max(ssally))
-
-  #bending the text along the leading path.
+  #recovering the extents of the main points of the text
+  allbbox = [cc.getbbox("nodes") for cc in bzctext]
+  xmin = min([bb[0] for bb in allbbox])
+  ymin = min([bb[1] for bb in allbbox])
+  xmax = max([bb[2] for bb in allbbox])
+  ymax = max([bb[3] for bb in allbbox])
+
+  #scaling the text to the length of the leading path if the leading path is shorted,
+  #and shifting it to the position of the leading path: the two are applied as one transform
+  xlen = xmax - xmin
+  bzcleadlen = bzclead.lentable()[-1]
+  scalefac = (bzcleadlen / xlen) if (bzcleadlen / xlen) < 1.0 else 1.0
+  shvertex = bzclead[0].getctrlp(1)
+  shx = shvertex['x'] - xmin*scalefac
+  shy = shvertex['y'] - ymax*scalefac
+  halfheight = ((ymax - ymin)*scalefac)/2.0 #halfheight corrects the text such that is half top half bottom the leading path
+
+  #bending the text along the leading path, each stroke goes straight from the transform to the bending
   basexdis = 0.04 * bzcleadlen
-  arbix = 10
   lowering = 0.95
   bentbzctext = []
-  halfheight = (max(ssally) - min(ssally))/2.0
-  for cbc in shiftedbzctext:
-    bentpoints = []
-    for cbcpp in cbc:
-      xdis = cbcpp.getctrlp(1)['x'] - shvertex['x']
-      plc, m = bzclead.getpointcbc((lowering*xdis) + basexdis)
-
-      tanangle = math.atan(m)
-      ortoangle = math.atan(-1.0/m)
-      angle = ortoangle if ortoangle < tanangle else ortoangle - math.pi
-      ydis = shvertex['y'] - cbcpp.getctrlp(1)['y'] - halfheight  #halfheight corrects the text such that is half top half bottom the leading path
-      finp = plc.pointatdistm(angle, ydis)
-      shiftvec = finp - cbcpp.getctrlp(1)
-      movcbc = cbcpp.shift(shiftvec['x'], shiftvec['y'])
-      fincbc = movcbc.rotate(tanangle)
-      bentpoints.append(fincbc)
-
-    bentbzctext.append(CompBezierCurve(*bentpoints))
-    bentbzctext[-1].closed = cbc.closed
+  for cbc in bzctext:
+    cbc.affine(scalefac, 0.0, 0.0, scalefac, shx, shy, inplace=True)
+    bentbzctext.append(bendcurve(bzclead, cbc, shvertex, halfheight, basexdis, lowering))
 
   #showing the text as a new path
   bentvec = pdb.gimp_vectors_new(img, "temporary")